@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#Compares the table/memo colour conversions in brywidgets/colours.py with calculating from scratch.
+#Run with CPython from the project folder:  python benchmarks/colourbench.py
+
+import importlib.util
+import os
+import random
+import timeit
+
+spec = importlib.util.spec_from_file_location("colours", os.path.join(os.path.dirname(__file__), "..", "brywidgets", "colours.py"))
+colours = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(colours)
+
+random.seed(1)
+#Dragging round the hue swatch and the white/black square
+drag = [(random.randrange(256*6), random.random(), random.random()) for i in range(10000)]
+#A palette of swatches, each converted many times
+palette = [tuple(random.randrange(256) for c in range(3)) for i in range(1000)]
+swatches = [random.choice(palette) for i in range(10000)]
+
+for huenumber, whitealpha, blackalpha in drag:
+    assert colours.calchwbtorgb(huenumber, whitealpha, blackalpha) == colours.hwbtorgb(huenumber, whitealpha, blackalpha)
+for colour in palette:
+    assert colours.calcrgbtohwb(colour) == colours.rgbtohwb(colour)
+
+def timeboth(name, calculated, engine, data):
+    t1 = min(timeit.repeat(lambda: [calculated(*args) for args in data], number=5, repeat=3))
+    t2 = min(timeit.repeat(lambda: [engine(*args) for args in data], number=5, repeat=3))
+    print(f"{name:10} calculated {t1*1000:8.2f} ms   engine {t2*1000:8.2f} ms   speedup {t1/t2:5.2f}x")
+
+timeboth("hwbtorgb", colours.calchwbtorgb, colours.hwbtorgb, drag)
+timeboth("rgbtohwb", colours.calcrgbtohwb, colours.rgbtohwb, [(colour,) for colour in swatches])
+
+#Batch conversions of a whole palette at once
+names = [colours.tupletohex(colour) for colour in swatches]
+buffer = colours.parsecolours(names)
+assert colours.buffertohex(buffer) == names
+huenumbers, whitealphas, blackalphas = colours.rgbtohwbbatch(buffer)
+for i, colour in enumerate(swatches):
+    assert colours.calcrgbtohwb(colour)[1:] == (huenumbers[i], whitealphas[i], blackalphas[i])
+assert list(colours.hwbtorgbbatch(*[[args[i] for args in drag] for i in range(3)])) == [c for args in drag for c in colours.calchwbtorgb(*args)[1]]
+
+def oneatatime():
+    return [colours.tupletohex(colours.hwbtorgb(*colours.rgbtohwb(colours.hextotuple(name))[1:])[1]) for name in names]
+def batch():
+    return colours.buffertohex(colours.hwbtorgbbatch(*colours.rgbtohwbbatch(colours.parsecolours(names))))
+assert oneatatime() == batch()
+t1 = min(timeit.repeat(oneatatime, number=5, repeat=3))
+t2 = min(timeit.repeat(batch, number=5, repeat=3))
+print(f"{'round trip':10} one at a time {t1*1000:8.2f} ms   batch {t2*1000:8.2f} ms   speedup {t1/t2:5.2f}x")
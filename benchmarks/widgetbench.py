@@ -0,0 +1,43 @@
+#Compares the time taken to create and lay out widgets styled inline, and styled by the generated
+#stylesheet (Global.useStylesheet = True).
+#Serve the project folder (eg python -m http.server) and open benchmarks/widgetbench.html in a browser.
+
+from browser import document, html, window
+import brywidgets as ws
+
+N = 200
+RUNS = 3
+
+def build(usestylesheet):
+    ws.Global.useStylesheet = usestylesheet
+    container = html.DIV()
+    document <= container
+    widgets = []
+    dialogs = []
+    for i in range(N):
+        widgets.append(ws.SpinControl(5, 0, 100))
+        widgets.append(ws.ToggleButton("Toggle", lambda event: None))
+        dialogs.append(ws.DialogBox("Dialog", style="standard", size=("200px", "100px")))
+        if i % 10 == 0:
+            dialogs.append(ws.ColourPickerDialog())
+            dialogs.append(ws.FileOpenDialog())
+    container <= widgets
+    return (container, dialogs)
+
+def run(usestylesheet):
+    built = []
+    time = ws.measurelayout(lambda: built.append(build(usestylesheet)))
+    (container, dialogs) = built[0]
+    ws.delete(container)
+    for dialog in dialogs: ws.delete(dialog.overlay)
+    return time
+
+times = {False:[], True:[]}
+for i in range(RUNS):
+    for usestylesheet in (False, True): times[usestylesheet].append(run(usestylesheet))
+
+widgetcount = N*3 + (N//10)*2
+document <= html.H2(f"Creating {widgetcount} widgets (best of {RUNS} runs)")
+document <= html.TABLE([html.TR([html.TH("Mode"), html.TH("Time (ms)")]),
+            html.TR([html.TD("Inline styles"), html.TD(f"{min(times[False]):.1f}")]),
+            html.TR([html.TD("Stylesheet"), html.TD(f"{min(times[True]):.1f}")])])
@@ -0,0 +1,17 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import cgi
+import cgitb; cgitb.enable()
+
+form = cgi.FieldStorage()
+path = "../"+form.getfirst("path")
+if os.path.isdir(path):
+    response = "folder"
+elif os.path.exists(path):
+    response = "file"
+else:
+    response = "none"
+
+print("Content-Type: text/html\n\n")
+print(response)
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2018-2021 Andy Lewis                                              #
+# --------------------------------------------------------------------------- #
+# For details, see the LICENSE file in this repository                        #
+
+#Colour utility functions.
+#This module does not use the browser module, so it can also be used in CPython (eg on the server).
+
+from functools import lru_cache
+try:
+    from array import array
+except ImportError:
+    array = None
+
+def rgbtotuple(colour):
+    return tuple([int(x) for x in colour[4:-1].split(",")])
+
+def tupletohex(colourtuple):
+    return "#"+''.join(format(n, '02x') for n in colourtuple)
+
+def hextotuple(hexcolour):
+    return tuple(int(hexcolour[i:i+2], 16) for i in [1, 3, 5])
+
+def calchue(huenumber):
+    '''The pure hue (R, G, B) at position huenumber (0 to 256*6-1) round the hue wheel.'''
+    i = huenumber % 256
+    if huenumber < 256: return (255, i, 0)
+    elif huenumber < 256*2: return (255-i, 255, 0)
+    elif huenumber < 256*3: return (0, 255, i)
+    elif huenumber < 256*4: return (0, 255-i, 255)
+    elif huenumber < 256*5: return (i, 0, 255)
+    else: return (255, 0, 255-i)
+
+def calcrgbtohwb(colour):
+    '''Convert an (R, G, B) tuple to hue, huenumber, whitealpha, blackalpha, calculating from scratch.'''
+    maxc = max(colour)
+    minc = min(colour)
+    whitealpha = 1 if maxc == 0 else minc/maxc
+    blackalpha = 1 - maxc/255
+
+    hue = (R, G, B) = (0, 255, 255) if maxc==minc else tuple(int(255*(c-minc)/(maxc-minc)) for c in colour)
+    if R == 255: huenumber = G if B==0 else (256*5)+255-B
+    elif G == 255: huenumber = (256*2)+B if R==0 else (256)+255-R
+    elif B == 255: huenumber = (256*4)+R if G==0 else (256*3)+255-G
+
+    return hue, huenumber, whitealpha, blackalpha
+
+def calchwbtorgb(hue, whitealpha, blackalpha):
+    '''Convert a hue (a huenumber or an (R, G, B) tuple) plus whitealpha and blackalpha to (hue, colour), calculating from scratch.'''
+    if isinstance(hue, int): hue = calchue(hue)
+    colour = tuple(int((1-blackalpha)*(C*(1-whitealpha)+255*whitealpha)) for C in hue)
+    return hue, colour
+
+class ColourEngine():
+    '''Colour conversions using a table of the 256*6 hues round the hue wheel, calculated once,
+    and a memo of the most recent memosize conversions from rgb.'''
+    def __init__(self, memosize=4096):
+        self.huetable = [calchue(huenumber) for huenumber in range(256*6)]
+        self.memo = lru_cache(maxsize=memosize)(calcrgbtohwb)
+
+    def hue(self, huenumber):
+        return self.huetable[min(max(huenumber, 0), 256*6-1)]
+
+    def rgbtohwb(self, colour):
+        if isinstance(colour, str): colour = rgbtotuple(colour)
+        return self.memo(tuple(colour))
+
+    def hwbtorgb(self, hue, whitealpha, blackalpha):
+        if isinstance(hue, int): hue = self.huetable[min(max(hue, 0), 256*6-1)]
+        (R, G, B) = hue
+        scale, tint, white = 1-blackalpha, 1-whitealpha, 255*whitealpha
+        return hue, (int(scale*(R*tint+white)), int(scale*(G*tint+white)), int(scale*(B*tint+white)))
+
+colourengine = ColourEngine()
+
+def rgbtohwb(colour):
+    return colourengine.rgbtohwb(colour)
+
+def hwbtorgb(hue, whitealpha, blackalpha):
+    return colourengine.hwbtorgb(hue, whitealpha, blackalpha)
+
+#Batch conversions.  Colours are held in flat buffers R, G, B, R, G, B... (arrays of unsigned bytes where the array module
+#is available, otherwise lists), so no tuple is created for each colour.
+
+hexbytes = [format(n, '02x') for n in range(256)]
+
+def newbuffer(typecode, values=()):
+    return array(typecode, values) if array else list(values)
+
+def parsecolours(colours):
+    '''Convert a sequence of CSS colour strings ("rgb(R, G, B)", "rgba(R, G, B, A)", "#rrggbb" or "#rgb") to a flat buffer of R, G, B values.'''
+    buffer = newbuffer("B")
+    append = buffer.append
+    for colour in colours:
+        colour = colour.strip()
+        if colour[0] == "#":
+            value = int(colour[1]*2+colour[2]*2+colour[3]*2 if len(colour) == 4 else colour[1:7], 16)
+            append(value >> 16)
+            append(value >> 8 & 255)
+            append(value & 255)
+        else:
+            parts = colour[colour.index("(")+1:colour.index(")")].split(",")
+            append(int(parts[0]))
+            append(int(parts[1]))
+            append(int(parts[2]))
+    return buffer
+
+def buffertohex(buffer):
+    '''Convert a flat buffer of R, G, B values to a list of colours in "#rrggbb" format.'''
+    return ["#"+hexbytes[buffer[i]]+hexbytes[buffer[i+1]]+hexbytes[buffer[i+2]] for i in range(0, len(buffer), 3)]
+
+def buffertorgb(buffer):
+    '''Convert a flat buffer of R, G, B values to a list of colours in "rgb(R, G, B)" format.'''
+    return [f"rgb({buffer[i]}, {buffer[i+1]}, {buffer[i+2]})" for i in range(0, len(buffer), 3)]
+
+def rgbtohwbbatch(buffer):
+    '''Convert a flat buffer of R, G, B values to three buffers: huenumbers, whitealphas and blackalphas
+    (the same values as rgbtohwb gives for each colour; the pure hue of each is colourengine.hue(huenumber)).'''
+    huenumbers, whitealphas, blackalphas = newbuffer("H"), newbuffer("d"), newbuffer("d")
+    for i in range(0, len(buffer), 3):
+        R, G, B = buffer[i], buffer[i+1], buffer[i+2]
+        maxc = R if R > G and R > B else (G if G > B else B)
+        minc = R if R < G and R < B else (G if G < B else B)
+        whitealphas.append(1 if maxc == 0 else minc/maxc)
+        blackalphas.append(1 - maxc/255)
+        if maxc == minc:
+            huenumbers.append(256*2+255)
+            continue
+        spread = maxc-minc
+        R, G, B = int(255*(R-minc)/spread), int(255*(G-minc)/spread), int(255*(B-minc)/spread)
+        if R == 255: huenumbers.append(G if B==0 else (256*5)+255-B)
+        elif G == 255: huenumbers.append((256*2)+B if R==0 else (256)+255-R)
+        else: huenumbers.append((256*4)+R if G==0 else (256*3)+255-G)
+    return huenumbers, whitealphas, blackalphas
+
+def hwbtorgbbatch(huenumbers, whitealphas, blackalphas):
+    '''Convert buffers of huenumbers, whitealphas and blackalphas to a flat buffer of R, G, B values.'''
+    buffer = newbuffer("B")
+    append = buffer.append
+    huetable = colourengine.huetable
+    for huenumber, whitealpha, blackalpha in zip(huenumbers, whitealphas, blackalphas):
+        R, G, B = huetable[min(max(huenumber, 0), 256*6-1)]
+        scale, tint, white = 1-blackalpha, 1-whitealpha, 255*whitealpha
+        append(int(scale*(R*tint+white)))
+        append(int(scale*(G*tint+white)))
+        append(int(scale*(B*tint+white)))
+    return buffer
@@ -0,0 +1,34 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os.path
+import hashlib
+import json
+import cgi
+import cgitb; cgitb.enable()
+
+#Applies a list of changes [start, count, text] (see linepatch in widgetset.py) to a saved file.
+#The file is only changed if its current contents match basehash and the result matches newhash.
+form = cgi.FieldStorage()
+filepath = "../"+form.getfirst("filepath")
+basehash = form.getfirst("basehash")
+newhash = form.getfirst("newhash")
+patch = json.loads(form.getfirst("patch"))
+
+response = "MISMATCH"
+if os.path.isfile(filepath):
+    f = open(filepath, "rb")
+    data = f.read()
+    f.close()
+    if hashlib.sha1(data).hexdigest() == basehash:
+        lines = data.decode("utf-8").splitlines(True)
+        for start, count, text in reversed(patch):
+            lines[start:start+count] = [text]
+        data = "".join(lines).encode("utf-8")
+        if hashlib.sha1(data).hexdigest() == newhash:
+            g = open(filepath, "wb")
+            g.write(data)
+            g.close()
+            response = "OK"
+
+print("Content-Type: text/html\n\n")
+print(response)
@@ -0,0 +1,47 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import cgi
+import cgitb; cgitb.enable()
+
+#action=chunk: store one chunk of an upload (uploadid, index, chunk)
+#action=assemble: join chunks 0 to count-1 of an upload into filepath, then discard them
+form = cgi.FieldStorage()
+action = form.getfirst("action", "chunk")
+uploadid = form.getfirst("uploadid", "")
+folder = os.path.join(tempfile.gettempdir(), "brywidgets-upload-"+uploadid)
+
+response = "NO"
+if uploadid.isalnum():
+    if action == "chunk":
+        index = int(form.getfirst("index"))
+        chunk = form.getfirst("chunk", "")
+        try:
+            os.mkdir(folder)
+        except OSError:
+            pass
+        g = open(os.path.join(folder, "%d.part" % index), "w")
+        g.write(chunk)
+        g.close()
+        os.rename(os.path.join(folder, "%d.part" % index), os.path.join(folder, str(index)))
+        response = "OK"
+    elif action == "assemble":
+        count = int(form.getfirst("count"))
+        filepath = "../"+form.getfirst("filepath")
+        chunkpaths = [os.path.join(folder, str(i)) for i in range(count)]
+        if all(os.path.exists(chunkpath) for chunkpath in chunkpaths):
+            g = open(filepath, "w")
+            for chunkpath in chunkpaths:
+                f = open(chunkpath)
+                g.write(f.read())
+                f.close()
+            g.close()
+            shutil.rmtree(folder)
+            response = "OK"
+        else:
+            response = "MISSING"
+
+print("Content-Type: text/html\n\n")
+print(response)
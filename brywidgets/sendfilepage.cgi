@@ -0,0 +1,35 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import cgi
+import cgitb; cgitb.enable()
+
+form = cgi.FieldStorage()
+folder = "../"+form.getfirst("folder")
+offset = int(form.getfirst("offset", "0"))
+limit = int(form.getfirst("limit", "500"))
+sortkey = form.getfirst("sort", "name")
+extlist = [ext for ext in form.getfirst("extlist", "").split(",") if ext]
+
+reverse = sortkey.startswith("-")
+sortkey = sortkey.lstrip("-")
+if sortkey == "mtime":
+    key = lambda d: os.path.getmtime(folder+"/"+d)
+elif sortkey == "size":
+    key = lambda d: os.path.getsize(folder+"/"+d)
+else:
+    key = None
+
+dirlist = os.listdir(folder)
+folderlist = [d for d in dirlist if os.path.isdir(folder+"/"+d)]
+filelist = [d for d in dirlist if not os.path.isdir(folder+"/"+d)]
+if extlist: filelist = [d for d in filelist if d.split(".")[-1] in extlist]
+folderlist.sort(key=key, reverse=reverse)
+filelist.sort(key=key, reverse=reverse)
+
+#Folders come before files; the page covers entries offset to offset+limit-1 of the combined list
+pagefolders = folderlist[offset:offset+limit]
+pagefiles = filelist[max(0, offset-len(folderlist)):max(0, offset+limit-len(folderlist))]
+
+print("Content-Type: text/html\n\n")
+print(chr(30).join([str(len(folderlist))+chr(31)+str(len(filelist)), chr(31).join(pagefolders), chr(31).join(pagefiles)]))
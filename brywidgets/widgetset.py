@@ -6,10 +6,16 @@
 # For details, see the LICENSE file in this repository                        #
 
 
-from browser import document, window, alert, confirm
+from browser import document, window, alert, confirm, timer
 import browser.html as html
 import browser.ajax as ajax
+import bisect
+import fnmatch
+import hashlib
+import json
+import random
 from .images import *
+from .colours import *
 
 #head = document.select("head")[0]
 #head.insertAdjacentElement("afterbegin", html.LINK(rel="stylesheet", href="brywidgets/widgetset.css", type="text/css"))
@@ -19,54 +25,398 @@ def delete(element):
     element.parentNode.removeChild(element)
     del element
 
+def installstylesheet():
+    '''Add the stylesheet for the widgets to the start of the head of the page (once only), so that it can be
+    overridden by the page's own stylesheets.  Called automatically when Global.useStylesheet is True.'''
+    global stylesheetinstalled
+    if stylesheetinstalled: return
+    rules = [f".bw-{name} {{"+"; ".join(f"{key}: {value}" for (key, value) in style.items())+"}" for (name, style) in widgetstyles.items()]
+    document.select("head")[0].insertAdjacentElement("afterbegin", html.STYLE("\n".join(rules), id="brywidgetsstylesheet"))
+    stylesheetinstalled = True
+
+def usestyle(element, name, values=None):
+    '''Style element using widgetstyles[name]: with the class bw-name if Global.useStylesheet is True, otherwise inline.
+    values is a dict of values for this element (eg {"width":"5em"}): these are set as custom properties
+    (--bw-name-width) used by the stylesheet rule, or inline.'''
+    if Global.useStylesheet:
+        installstylesheet()
+        element.classList.add("bw-"+name)
+        if values:
+            for (key, value) in values.items(): element.style.setProperty(f"--bw-{name}-{key}", value)
+    else:
+        element.style = inlinestyles[name]
+        if values: element.style = values
+
 def gettextwidth(text, font="12pt Arial"):
-    canvas = html.CANVAS()
-    ctx = canvas.getContext("2d")
-    ctx.font = font
-    return ctx.measureText(text).width
-
-#Colour utility functions
-
-def rgbtotuple(colour):
-    return tuple([int(x) for x in colour[4:-1].split(",")])
-
-def tupletohex(colourtuple):
-    return "#"+''.join(format(n, '02x') for n in colourtuple)
-
-def hextotuple(hexcolour):
-    return tuple(int(hexcolour[i:i+2], 16) for i in [1, 3, 5])
-
-def rgbtohwb(colour):
-    if isinstance(colour, str): colour = rgbtotuple(colour)
-    maxc = max(colour); maxi = colour.index(maxc)
-    minc = min(colour); mini = colour.index(minc)
-    whitealpha = 1 if maxc == 0 else minc/maxc
-    blackalpha = 1 - maxc/255
-
-    hue = (R, G, B) = (0, 255, 255) if maxc==minc else tuple(int(255*(c-minc)/(maxc-minc)) for c in colour)
-    if R == 255: huenumber = G if B==0 else (256*5)+255-B
-    elif G == 255: huenumber = (256*2)+B if R==0 else (256)+255-R
-    elif B == 255: huenumber = (256*4)+R if G==0 else (256*3)+255-G
-
-    return hue, huenumber, whitealpha, blackalpha
-
-def hwbtorgb(hue, whitealpha, blackalpha):
-    if isinstance(hue, int):
-        i = hue % 256
-        if hue < 256: (R, G, B) = (255, i, 0)
-        elif 256 <= hue < 256*2: (R, G, B) = (255-i,255,0)
-        elif 256*2 <= hue < 256*3: (R, G, B) = (0,255,i)
-        elif 256*3 <= hue < 256*4: (R, G, B) = (0,255-i,255)
-        elif 256*4 <= hue < 256*5: (R, G, B) = (i,0,255)
-        elif 256*5 <= hue < 256*6: (R, G, B) = (255,0,255-i)
-        hue = (R, G, B)
-    colour = tuple(int((1-blackalpha)*(C*(1-whitealpha)+255*whitealpha)) for C in hue)
-    return hue, colour
+    return textmeasurer.measure(text, font)
+
+def normalisefolder(folder):
+    '''Remove "." and empty components from a folder path, so that eg "./users/demo/" becomes "users/demo".'''
+    return "/".join(part for part in folder.split("/") if part not in ("", "."))
+
+def invalidatelisting(folder):
+    '''Discard any cached listings of folder, eg after a file has been saved in it.'''
+    folder = normalisefolder(folder)
+    listingcache.removeif(lambda key: key[0] == folder)
+
+def increasingpositions(sequence):
+    '''Return the set of positions in sequence which make up its longest increasing subsequence.
+    Entries of -1 are ignored.'''
+    tails, tailpositions, previous = [], [], {}
+    for position, value in enumerate(sequence):
+        if value == -1: continue
+        i = bisect.bisect_left(tails, value)
+        if i == len(tails):
+            tails.append(value)
+            tailpositions.append(position)
+        else:
+            tails[i] = value
+            tailpositions[i] = position
+        previous[position] = tailpositions[i-1] if i > 0 else None
+    positions = set()
+    position = tailpositions[-1] if tailpositions else None
+    while position is not None:
+        positions.add(position)
+        position = previous[position]
+    return positions
+
+def globliterals(pattern):
+    '''Split a glob pattern into the runs of literal text outside wildcards and [...] sets, following the rules of fnmatch
+    (a set may begin with ! and then ], and a [ with no closing ] is literal).
+    Returns (list of runs, True if the pattern begins with the first run).'''
+    literals = []
+    current = ""
+    startsliteral = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        end = -1
+        if c == "[":
+            j = i+1
+            if j < len(pattern) and pattern[j] == "!": j += 1
+            if j < len(pattern) and pattern[j] == "]": j += 1
+            end = pattern.find("]", j)
+        if c in "*?" or end >= 0:
+            if current:
+                if not literals and current == pattern[:len(current)]: startsliteral = True
+                literals.append(current)
+            current = ""
+            i = end+1 if end >= 0 else i+1
+        else:
+            current += c
+            i += 1
+    if current:
+        if not literals and current == pattern: startsliteral = True
+        literals.append(current)
+    return (literals, startsliteral)
+
+def textdigest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def linepatch(old, new):
+    '''Return a list of changes which turn the text old into the text new.
+    Each change is [start, count, text]: replace count lines of old, starting at line start (counting from 0), by text.
+    The changes are in order, and the line numbers all refer to old.
+    Lines which occur exactly once in each text are matched up first (as in a "patience" diff),
+    then the matching lines on either side of them are extended.'''
+    a, b = old.splitlines(True), new.splitlines(True)
+    counts = {}
+    for line in a: counts[line] = counts.get(line, 0) + 1
+    for line in b: counts[line] = counts.get(line, 0) - 1000
+    positions = {line:i for i, line in enumerate(a) if counts[line] == -999}
+    pairs = [(positions[line], j) for j, line in enumerate(b) if counts[line] == -999]
+    anchors = [pairs[k] for k in sorted(increasingpositions([i for i, j in pairs]))] + [(len(a), len(b))]
+    changes = []
+    i = j = 0
+    for anchori, anchorj in anchors:
+        while i < anchori and j < anchorj and a[i] == b[j]: i, j = i+1, j+1
+        endi, endj = anchori, anchorj
+        while endi > i and endj > j and a[endi-1] == b[endj-1]: endi, endj = endi-1, endj-1
+        if endi > i or endj > j: changes.append([i, endi-i, "".join(b[j:endj])])
+        i, j = anchori+1, anchorj+1
+    return changes
+
+def updatechoices(select, newchoices, key=None):
+    '''Not intended to be called by end user.  Use the setchoices method of a DropDown or ListBox.
+    Changes the OPTIONs of select to match newchoices, inserting, removing and moving only those which have changed.
+    Options are matched by their text, or by key(choice) if a key function is given.'''
+    if key is None: key = lambda choice: choice
+    newchoices = list(newchoices)
+    oldoptions = select.optionlist
+    selected = select.selectedIndex
+    unused = {}
+    for i in range(len(select.choices)-1, -1, -1):
+        unused.setdefault(key(select.choices[i]), []).append(i)
+    #The selected option is kept for the first new choice with its key, even if there are other old options with that key
+    keepselected = selected >= 0
+    if keepselected:
+        selectedkey = key(select.choices[selected])
+        unused[selectedkey].remove(selected)
+    sources = []
+    for choice in newchoices:
+        if keepselected and key(choice) == selectedkey:
+            sources.append(selected)
+            keepselected = False
+            continue
+        oldindices = unused.get(key(choice))
+        sources.append(oldindices.pop() if oldindices else -1)
+    if keepselected: unused[selectedkey].append(selected)
+    for oldindices in unused.values():
+        for i in oldindices: delete(oldoptions[i])
+    stable = increasingpositions(sources)
+    newoptions = [None]*len(newchoices)
+    nextoption = None
+    for i in range(len(newchoices)-1, -1, -1):
+        if sources[i] == -1:
+            option = html.OPTION(newchoices[i])
+        else:
+            option = oldoptions[sources[i]]
+            if option.text != str(newchoices[i]): option.text = newchoices[i]
+        if i not in stable:
+            if nextoption is None: select.appendChild(option)
+            else: select.insertBefore(option, nextoption)
+        newoptions[i] = nextoption = option
+    select.choices = newchoices
+    select.optionlist = newoptions
+    return sources.index(selected) if selected >= 0 and selected in sources else -1
 
 class Global():
     '''Global parameters'''
     alertStyle = "standard"
     promptStyle = "standard"
+    fileListPageSize = None
+    fileListSort = "name"
+    listingCacheFreshness = 2000
+    fileFilterMode = "prefix"
+    uploadChunkSize = None
+    uploadConcurrency = 4
+    uploadRetries = 3
+    uploadProgress = None
+    deltaSave = False
+    dialogIdleTimeout = None
+    exportConcurrency = 2
+    maxCanvasSide = 16384
+    maxCanvasArea = 268435456
+    useStylesheet = False
+
+#Styles for the widgets.  Each is used either as inline styles, or (if Global.useStylesheet is True) as a rule in a
+#stylesheet which is added to the page once.  Values which vary between widgets are given by CSS custom properties.
+widgetstyles = {
+    "overlay": {"position":"fixed", "top":"0px", "bottom":"0px", "left":"0px", "right":"0px", "visibility":"hidden", "background-color":"transparent", "display":"flex", "align-items":"center"},
+    "overlaypanel": {"position":"absolute", "top":"0px", "left":"0px", "width":"100%", "height":"100%"},
+    "standardpanel": {"background-color":"lightgrey", "text-align":"center", "padding-bottom":"0.5em"},
+    "paneltitlebar": {"position":"relative", "width":"100%", "height":"1.2em", "text-align":"center"},
+    "dialogbox": {"position":"relative", "z-index":"1", "margin":"auto"},
+    "standarddialog": {"width":"33%", "background-color":"lightgrey", "border":"1px solid grey", "text-align":"center", "padding-bottom":"0.5em"},
+    "dialogsize": {"width":"var(--bw-dialogsize-width)", "height":"var(--bw-dialogsize-height)"},
+    "dialogtitlebar": {"position":"relative", "width":"100%", "height":"1.3em", "text-align":"center"},
+    "standardtitlebar": {"background-color":"grey", "color":"white"},
+    "closebutton": {"position":"absolute", "top":"0px", "right":"0px", "height":"100%"},
+    "placed": {"position":"absolute", "left":"var(--bw-placed-left)", "top":"var(--bw-placed-top)", "width":"var(--bw-placed-width)", "height":"var(--bw-placed-height)"},
+    "recentcolour": {"border":"1px solid black", "background-color":"white"},
+    "spincontrol": {"border":"1px solid blue", "height":"1.1em", "width":"var(--bw-spincontrol-width)", "text-align":"center"},
+    "spinminus": {"height":"100%", "float":"left"},
+    "spinplus": {"height":"100%", "float":"right"},
+    "spinvalue": {"cursor":"default"},
+    "raised": {"border-color":"white grey grey white"},
+    "lowered": {"border-color":"grey white white grey"},
+    "filedialogpart": {"display":"block", "width":"90%", "padding":"0.1em", "margin":"0.1em auto"},
+    "filelist": {"background-color":"white", "border":"1px solid black", "height":"70vh", "overflow":"auto", "white-space":"nowrap"},
+    "filebuttons": {"text-align":"right"},
+    "filelist li": {"text-align":"left", "list-style":"none", "padding":"0px 0px 0px 20px", "margin":"0px", "cursor":"default"},
+    "filelist li.parentfolder": {"background":f"url({uparrow_b64}) no-repeat left top"},
+    "filelist li.folder": {"background":f"url({folder_b64}) no-repeat left top"},
+    "filelist li.file": {"background":f"url({file_b64}) no-repeat left top"},
+}
+#The same styles without the custom properties, for use as inline styles
+inlinestyles = {name:{key:value for (key, value) in style.items() if "var(" not in value} for (name, style) in widgetstyles.items()}
+stylesheetinstalled = False
+
+class LRUCache():
+    '''A store of values which holds at most maxentries values, and (if maxbytes is given) at most maxbytes in total,
+    as measured by the function sizeof.  When either limit is exceeded, the least recently used values are discarded.'''
+    def __init__(self, maxentries=100, maxbytes=None, sizeof=len):
+        self.entries = {}
+        self.sizes = {}
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.totalbytes = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries: return default
+        self.entries[key] = value = self.entries.pop(key)
+        return value
+
+    def put(self, key, value):
+        self.remove(key)
+        size = self.sizeof(value)
+        if self.maxbytes is not None and size > self.maxbytes: return
+        self.entries[key] = value
+        self.sizes[key] = size
+        self.totalbytes += size
+        while len(self.entries) > self.maxentries or (self.maxbytes is not None and self.totalbytes > self.maxbytes):
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        if key not in self.entries: return
+        del self.entries[key]
+        self.totalbytes -= self.sizes.pop(key)
+
+    def removeif(self, test):
+        for key in [key for key in self.entries if test(key)]: self.remove(key)
+
+    def clear(self):
+        self.entries, self.sizes, self.totalbytes = {}, {}, 0
+
+class TextMeasurer():
+    '''Measures the width of text in pixels.  One canvas is used for all measurements, and the most recent widths
+    (up to maxentries) are remembered.  Remembered widths are discarded whenever the browser finishes loading a font.
+    Available methods: measure, measureall, clear'''
+    def __init__(self, maxentries=5000):
+        self.ctx = None
+        self.font = None
+        self.widths = LRUCache(maxentries, sizeof=lambda width: 0)
+
+    def setfont(self, font):
+        if not self.ctx:
+            self.ctx = html.CANVAS().getContext("2d")
+            if hasattr(document, "fonts"): document.fonts.addEventListener("loadingdone", lambda event: self.clear())
+        if font != self.font:
+            self.ctx.font = font
+            self.font = font
+
+    def measure(self, text, font="12pt Arial"):
+        width = self.widths.get((font, text))
+        if width is None:
+            self.setfont(font)
+            width = self.ctx.measureText(text).width
+            self.widths.put((font, text), width)
+        return width
+
+    def measureall(self, texts, font="12pt Arial"):
+        '''Return a list of the widths of texts (a list of strings), setting the font only once.'''
+        widths = [self.widths.get((font, text)) for text in texts]
+        for (i, text) in enumerate(texts):
+            if widths[i] is not None: continue
+            self.setfont(font)
+            widths[i] = self.ctx.measureText(text).width
+            self.widths.put((font, text), widths[i])
+        return widths
+
+    def clear(self):
+        self.widths.clear()
+
+class DialogRegistry():
+    '''Not intended to be created by end user.  Holds the dialogs which are shared by all the widgets on a page
+    (the colour picker, file dialogs, alert dialog etc.), creating each one the first time it is needed.
+    If Global.dialogIdleTimeout is set (in ms), dialogs registered as releasable are removed from the page when they
+    have been hidden for that long, and created again the next time they are needed.
+    constructiontimes records the time in ms taken to create each dialog.'''
+    def __init__(self):
+        self.factories = {}
+        self.releasable = set()
+        self.dialogs = {}
+        self.timers = {}
+        self.constructiontimes = {}
+
+    def register(self, name, factory, releasable=False):
+        self.factories[name] = factory
+        if releasable: self.releasable.add(name)
+
+    def get(self, name):
+        '''Return the dialog called name, creating it if necessary.'''
+        if name not in self.dialogs:
+            start = window.performance.now()
+            dialog = self.factories[name]()
+            dialog.registryname = name
+            self.dialogs[name] = dialog
+            self.constructiontimes[name] = window.performance.now() - start
+        return self.dialogs[name]
+
+    def existing(self, name):
+        '''Return the dialog called name if it has been created, otherwise None.'''
+        return self.dialogs.get(name)
+
+    def onshow(self, dialog):
+        name = getattr(dialog, "registryname", None)
+        if name in self.timers: timer.clear_timeout(self.timers.pop(name))
+
+    def onhide(self, dialog):
+        name = getattr(dialog, "registryname", None)
+        if name not in self.releasable or Global.dialogIdleTimeout is None: return
+        if name in self.timers: timer.clear_timeout(self.timers.pop(name))
+        self.timers[name] = timer.set_timeout(lambda: self.release(name), Global.dialogIdleTimeout)
+
+    def release(self, name):
+        '''Remove the dialog called name from the page; it will be created again when next needed.'''
+        if name in self.timers: timer.clear_timeout(self.timers.pop(name))
+        dialog = self.dialogs.pop(name, None)
+        if dialog: delete(dialog.overlay)
+
+class NameIndex():
+    '''An index of a list of names, for finding quickly those which match some text typed by the user.
+    Matching ignores case.  Each method returns a list of the positions in names of the names which match.'''
+    def __init__(self, names):
+        self.names = [name.lower() for name in names]
+        order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        self.sortednames = [self.names[i] for i in order]
+        self.order = order
+        self.trigrams = None
+
+    def prefix(self, text):
+        '''Names beginning with text (found by binary search of the sorted names).'''
+        text = text.lower()
+        start = bisect.bisect_left(self.sortednames, text)
+        end = bisect.bisect_left(self.sortednames, text+"\uffff", start)
+        return sorted(self.order[start:end])
+
+    def gettrigrams(self):
+        if self.trigrams is None:
+            self.trigrams = {}
+            for i, name in enumerate(self.names):
+                for trigram in {name[j:j+3] for j in range(len(name)-2)}:
+                    self.trigrams.setdefault(trigram, []).append(i)
+        return self.trigrams
+
+    def candidates(self, text):
+        '''Positions of names which might contain text, using the trigram index when text is long enough.'''
+        if len(text) < 3: return range(len(self.names))
+        trigrams = self.gettrigrams()
+        postings = sorted((trigrams.get(text[j:j+3], []) for j in range(len(text)-2)), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            if not result: break
+            result.intersection_update(posting)
+        return sorted(result)
+
+    def substring(self, text):
+        '''Names containing text.'''
+        text = text.lower()
+        return [i for i in self.candidates(text) if text in self.names[i]]
+
+    def glob(self, pattern):
+        '''Names matching pattern, which may contain the wildcards * ? and [...].'''
+        pattern = pattern.lower()
+        (literals, startsliteral) = globliterals(pattern)
+        if startsliteral:
+            candidates = self.prefix(literals[0])
+        elif literals:
+            candidates = self.candidates(max(literals, key=len))
+        else:
+            candidates = range(len(self.names))
+        return [i for i in candidates if fnmatch.fnmatchcase(self.names[i], pattern)]
+
+    def match(self, text, mode="prefix"):
+        '''Names matching text: by glob if text contains a wildcard, otherwise by prefix or substring according to mode.'''
+        if any(c in text for c in "*?["): return self.glob(text)
+        return self.substring(text) if mode == "substring" else self.prefix(text)
 
 class Notebook(html.DIV):
     '''A tabbed set of pages; switch between pages by clicking on a tab.
@@ -75,37 +425,131 @@ class Notebook(html.DIV):
         page1 = NotebookPage("First page", "lightgreen")
         page2 = NotebookPage("Second page", "powderblue")
         nb = Notebook([page1, page2])
-    More pages can be added using nb.addpage.
+    More pages can be added using nb.addpage (or nb.addpages to add several at once).
     The height of the tabs is automatically set to accomodate 1 line of text, but can be adjusted
-    by specifying the parameter tabheight in CSS units.'''
-
-    def __init__(self, pagelist=[], tabheight="2em", className=None, id=None):
+    by specifying the parameter tabheight in CSS units.
+    If tablayout is "wrap" or "scroll", the width of each tab is calculated from its title (ignoring the pages' tabwidth),
+    and tabs which do not fit across the notebook either wrap onto more rows, or are shown in a row which scrolls sideways.
+    tabfont is the CSS font of the tab titles, used for measuring them.  If not given, the font is found from the page;
+    if the notebook is not yet in the page, the tabs are measured once it has been added (checked on each animation frame
+    for about two seconds, and after that whenever a page is selected).
+    layouttabs() can be called to recalculate the widths.
+    Pages created with a factory are only put in the page when first selected.  If maxloaded is set, then when more than
+    that number of these pages are loaded, the least recently viewed ones are removed (and recreated when next selected).'''
+
+    def __init__(self, pagelist=[], tabheight="2em", tablayout=None, tabfont=None, maxloaded=None, className=None, id=None):
         html.DIV.__init__(self, "", Class="notebook")
         self.clearfloat = html.DIV(style={"clear":"both"})
         self.tabrow = html.DIV(self.clearfloat, Class="notebooktabrow", style={"text-align":"center"})
+        if tablayout == "scroll": self.tabrow.style = {"white-space":"nowrap", "overflow-x":"auto", "overflow-y":"hidden"}
         self.tabheight = tabheight
+        self.tablayout = tablayout
+        self.tabfont = tabfont
+        self.maxloaded = maxloaded
+        self.layoutpending = False
+        self.layoutframes = 0
         self <= self.tabrow
         self.pagelist = []
-        for page in pagelist: self.addpage(page)
+        self.currentindex = None
+        self.loadedpages = []
+        self.addpages(pagelist)
         if className: self.classList.add(className)
         if id: self.id = id
 
     def addpage(self, page):
+        self.addpages([page])
+
+    def addpages(self, pages):
+        '''Add a list of pages, inserting all their tabs at once.'''
+        if not pages: return
+        tabs = document.createDocumentFragment()
+        for page in pages:
+            if page.loaded: self <= page
+            page.tab = NotebookTab(self, len(self.pagelist), page.tabtitle, self.tabheight, None if self.tablayout else page.tabwidth)
+            page.tab.style.backgroundColor = page.style.backgroundColor
+            if self.tablayout == "scroll": page.tab.style = {"float":"none", "display":"inline-block", "vertical-align":"top"}
+            if page.id: page.tab.id = page.id+"_tab"
+            tabs <= page.tab
+            page.style.display = "none"
+            self.pagelist.append(page)
+        self.tabrow.insertBefore(tabs, self.clearfloat)
+        if self.tablayout: self.layouttabs(pages)
+        if self.currentindex is None: self.selectpage(0, update=False)
+
+    def selectpage(self, index, update=True):
+        '''Show page number index (counting from 0).  Only the page currently shown and the new page are changed.'''
+        page = self.pagelist[index]
+        if self.currentindex is not None: self.pagelist[self.currentindex].style.display = "none"
+        self.currentindex = index
+        if page.factory:
+            if not page.loaded: self.loadpage(page)
+            self.loadedpages.remove(page)
+            self.loadedpages.append(page)
+            if self.maxloaded is not None:
+                while len(self.loadedpages) > max(self.maxloaded, 1): self.unloadpage(self.loadedpages[0])
+        page.style.display = "block"
+        if self.layoutpending and self.gettabfont(): self.layouttabs()
+        if update: page.update()
+
+    def loadpage(self, page):
+        content = page.factory(page)
+        if content: page <= content
+        page.loaded = True
         self <= page
-        page.tab = NotebookTab(self, len(self.pagelist), page.tabtitle, self.tabheight, page.tabwidth)
-        page.tab.style.backgroundColor = page.style.backgroundColor
-        if page.id: page.tab.id = page.id+"_tab"
-        self.tabrow.insertBefore(page.tab, self.clearfloat)
-        page.style.display="block" if len(self.pagelist)==0 else "none"
-        self.pagelist.append(page)
+        self.loadedpages.append(page)
+
+    def unloadpage(self, page):
+        '''Remove a page made by a factory from the document; it will be made again when next selected.'''
+        delete(page)
+        page.clear()
+        page.loaded = False
+        self.loadedpages.remove(page)
+
+    def layouttabs(self, pages=None):
+        '''Set the widths of the tabs of pages (default: all pages) from their titles, measuring them all in one batch.'''
+        if pages is None: pages = self.pagelist
+        if not pages: return
+        font = self.tabfont if self.tabfont else self.gettabfont()
+        if not font:
+            #Not in the page yet, so the font is unknown: measure all the tabs once the notebook has been added
+            if not self.layoutpending:
+                self.layoutpending = True
+                self.layoutframes = 120
+                window.requestAnimationFrame(self.onlayoutframe)
+            return
+        if pages is self.pagelist: self.layoutpending = False
+        widths = textmeasurer.measureall([page.tabtitle for page in pages], font)
+        for (page, width) in zip(pages, widths): page.tab.style.width = f"calc({int(width)+2}px + 0.8em)"
+
+    def gettabfont(self):
+        '''Return the font of the tab titles, built from the separate font properties (the font shorthand is empty in some browsers),
+        or None if the notebook is not in the page.'''
+        if not self.isConnected: return None
+        style = window.getComputedStyle(self.pagelist[0].tab.firstChild)
+        if not style.fontSize or not style.fontFamily: return None
+        return f"{style.fontStyle} {style.fontWeight} {style.fontSize} {style.fontFamily}"
+
+    def onlayoutframe(self, timestamp):
+        '''Measure the tabs if the notebook is now in the page; keep checking for at most layoutframes more frames.
+        After that, the tabs are measured when a page is next selected, or when layouttabs() is called.'''
+        if not self.layoutpending: return
+        if self.gettabfont():
+            self.layouttabs()
+        elif self.layoutframes > 0:
+            self.layoutframes -= 1
+            window.requestAnimationFrame(self.onlayoutframe)
 
 class NotebookPage(html.DIV):
     '''A page in a notebook.  Create with a title (which appears on its tab), and a background colour.
-    Optionally include content at creation time, or else add it later.'''
-    def __init__(self, title, bgcolour, content=None, tabwidth="10%", className=None, id=None):
+    Optionally include content at creation time, or else add it later.
+    Alternatively, give a factory: a function which takes the page as argument, and is called when the page is first
+    selected.  It can either add content to the page itself, or return the content to be added.'''
+    def __init__(self, title, bgcolour, content=None, tabwidth="10%", factory=None, className=None, id=None):
         html.DIV.__init__(self, "", style={"background-color":bgcolour}, Class="notebookpage")
         self.tabtitle = title
         self.tabwidth = tabwidth
+        self.factory = factory
+        self.loaded = factory is None
         if className: self.classList.add(className)
         if id: self.id = id
         if content: self <= content
@@ -124,10 +568,7 @@ class NotebookTab(html.DIV):
         self.bind("click", self.select)
 
     def select(self, event=None):
-        for p in self.notebook.pagelist:
-            p.style.display="none"
-        self.notebook.pagelist[self.tabindex].style.display="block"
-        self.notebook.pagelist[self.tabindex].update()
+        self.notebook.selectpage(self.tabindex)
 
 class DropDown(html.SELECT):
     '''Dropdown list of options.
@@ -138,12 +579,21 @@ class DropDown(html.SELECT):
     initialchoice: index (counting from 0) of the inital choice.'''
     def __init__(self, choices, onchange, initialchoice=None, className=None, id=None):
         html.SELECT.__init__(self, "", Class="dropdown")
-        self <= (html.OPTION(text) for text in choices)
+        self.choices = list(choices)
+        self.optionlist = [html.OPTION(text) for text in self.choices]
+        self <= self.optionlist
         self.bind("change", onchange)
         if initialchoice: self.selectedIndex = initialchoice
         if className: self.classList.add(className)
         if id: self.id = id
 
+    def setchoices(self, newchoices, key=None):
+        '''Replace the list of options, changing only those options which differ.
+        Options are matched by their text, or by key(choice) if a key function is given.
+        If the currently selected option is still present, it remains selected.'''
+        selected = updatechoices(self, newchoices, key)
+        self.selectedIndex = selected if selected >= 0 else 0
+
 class ListBox(html.SELECT):
     '''List of options (all shown unless the number to show is given in which case a scroll bar is used).
     Required parameters
@@ -154,13 +604,160 @@ class ListBox(html.SELECT):
     initialchoice: index (counting from 0) of the inital choice.'''
     def __init__(self, choices, onchange, size=None, initialchoice=None, className=None, id=None):
         html.SELECT.__init__(self, "", Class="listbox")
-        self <= (html.OPTION(text) for text in choices)
+        self.choices = list(choices)
+        self.optionlist = [html.OPTION(text) for text in self.choices]
+        self <= self.optionlist
         self.bind("change", onchange)
-        self.size = size if size else len(choices)
+        self.autosize = not size
+        self.size = size if size else len(self.choices)
         self.selectedIndex = initialchoice if initialchoice else -1
         if className: self.classList.add(className)
         if id: self.id = id
 
+    def setchoices(self, newchoices, key=None):
+        '''Replace the list of options, changing only those options which differ.
+        Options are matched by their text, or by key(choice) if a key function is given.
+        If the currently selected option is still present, it remains selected.'''
+        self.selectedIndex = updatechoices(self, newchoices, key)
+        if self.autosize: self.size = len(self.choices)
+
+class VirtualListBox(html.DIV):
+    '''List of options for very long lists.  Only the rows which are visible (plus a margin of overscan rows
+    above and below) are in the document; they are reused as the list is scrolled.
+    Behaves like a ListBox: onchange is called with a change event whose target is the VirtualListBox,
+    and selectedIndex, value and size can be read or set.
+    Required parameters
+    choices: a list of options
+    onchange: function to be called when the user chooses a different option.  Takes the change event as argument.
+    Optional parameters:
+    size: number of choices to be displayed (default 10)
+    initialchoice: index (counting from 0) of the inital choice.
+    rowheight: height of each row in pixels
+    overscan: number of extra rows rendered above and below the visible ones.'''
+    def __init__(self, choices, onchange, size=10, initialchoice=None, rowheight=20, overscan=10, className=None, id=None):
+        html.DIV.__init__(self, "", Class="virtuallistbox", tabindex=0,
+                    style={"position":"relative", "overflow-y":"auto", "border":"1px solid grey", "background-color":"white", "cursor":"default"})
+        self.choices = list(choices)
+        self.rowheight = rowheight
+        self.overscan = overscan
+        self.rows = []
+        self.firstrow = 0
+        self._selectedIndex = -1
+        self.spacer = html.DIV("", style={"position":"relative", "height":f"{len(self.choices)*rowheight}px"})
+        self <= self.spacer
+        self.spacer.bind("click", self.onrowclick)
+        self.bind("scroll", self.render)
+        self.bind("keydown", self.onKeydown)
+        self.bind("change", onchange)
+        self.size = size
+        if initialchoice: self.selectedIndex = initialchoice
+        if className: self.classList.add(className)
+        if id: self.id = id
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self, size):
+        self._size = size
+        self.style.height = f"{size*self.rowheight}px"
+        self.render()
+
+    @property
+    def selectedIndex(self):
+        return self._selectedIndex
+
+    @selectedIndex.setter
+    def selectedIndex(self, index):
+        self._selectedIndex = index
+        if index >= 0:
+            top = index*self.rowheight
+            if top < self.scrollTop: self.scrollTop = top
+            elif top+self.rowheight > self.scrollTop+self._size*self.rowheight: self.scrollTop = top+self.rowheight-self._size*self.rowheight
+        self.render()
+
+    @property
+    def value(self):
+        return self.choices[self._selectedIndex] if 0 <= self._selectedIndex < len(self.choices) else ""
+
+    @value.setter
+    def value(self, value):
+        '''As with a SELECT, select the first choice equal to value, or nothing if there is none.'''
+        self.selectedIndex = next((i for i, choice in enumerate(self.choices) if str(choice) == str(value)), -1)
+
+    def render(self, event=None):
+        '''Fill the pool of row elements with the choices currently in view.'''
+        first = max(0, int(self.scrollTop)//self.rowheight - self.overscan)
+        last = min(len(self.choices), first + self._size + 2*self.overscan)
+        rowstyle = {"position":"absolute", "left":"0px", "right":"0px", "height":f"{self.rowheight}px", "line-height":f"{self.rowheight}px",
+                    "padding":"0px 2px", "overflow":"hidden", "white-space":"nowrap"}
+        while len(self.rows) < last-first:
+            self.rows.append(row := html.DIV("", Class="virtuallistrow", style=rowstyle))
+            row.rowindex = -1
+            row.selected = False
+            self.spacer <= row
+        for i, row in enumerate(self.rows):
+            index = first + i
+            if index < last:
+                if row.rowindex != index:
+                    if row.rowindex < 0: row.style.display = "block"
+                    row.text = self.choices[index]
+                    row.style.top = f"{index*self.rowheight}px"
+                    row.attrs["data-index"] = str(index)
+                    row.rowindex = index
+                selected = index == self._selectedIndex
+                if selected != row.selected:
+                    row.style.backgroundColor = "highlight" if selected else "transparent"
+                    row.style.color = "highlighttext" if selected else "inherit"
+                    row.selected = selected
+            elif row.rowindex != -1:
+                row.rowindex = -1
+                row.style.display = "none"
+        self.firstrow = first
+
+    def setchoices(self, newchoices, key=None):
+        '''Replace the list of options.  Only the visible rows are redrawn.
+        If the currently selected option is still present (matched by its text, or by key(choice)
+        if a key function is given), it remains selected.'''
+        if key is None: key = lambda choice: choice
+        newchoices = list(newchoices)
+        selected = self.selectedIndex
+        if 0 <= selected < len(self.choices):
+            selectedkey = key(self.choices[selected])
+            selected = next((i for i, choice in enumerate(newchoices) if key(choice) == selectedkey), -1)
+        self.choices = newchoices
+        self._selectedIndex = -1
+        self.refresh()
+        if selected >= 0: self.selectedIndex = selected
+
+    def refresh(self):
+        '''Redraw every row, eg after the list of choices has been changed.'''
+        for row in self.rows: row.rowindex = -2
+        self.spacer.style.height = f"{len(self.choices)*self.rowheight}px"
+        self.render()
+
+    def choose(self, index):
+        if index == self._selectedIndex or not 0 <= index < len(self.choices): return
+        self.selectedIndex = index
+        self.dispatchEvent(window.Event.new("change"))
+
+    def onrowclick(self, event):
+        index = event.target.attrs.get("data-index")
+        if index is not None: self.choose(int(index))
+
+    def onKeydown(self, event):
+        steps = {"ArrowDown":1, "ArrowUp":-1, "PageDown":self._size, "PageUp":-self._size}
+        if event.key in steps:
+            event.preventDefault()
+            self.choose(min(len(self.choices)-1, max(0, self._selectedIndex + steps[event.key])))
+        elif event.key == "Home":
+            event.preventDefault()
+            self.choose(0)
+        elif event.key == "End":
+            event.preventDefault()
+            self.choose(len(self.choices)-1)
+
 class InputBox(html.INPUT):
     '''Standard input box.
     Required parameter:
@@ -185,18 +782,21 @@ class SpinControl(html.DIV):
     Optional parameter:
     stepvalue: the amount by which the value is increased or decreased (default is 1)'''
     def __init__(self, initialvalue, minvalue, maxvalue, action=None, stepvalue=1, className=None, id=None):
-        decrease = html.IMG(src=minus_b64, id="minus", style={"height":"100%", "float":"left"})
+        decrease = html.IMG(src=minus_b64, id="minus")
+        usestyle(decrease, "spinminus")
         decrease.bind("click", self.ondecrease)
-        increase = html.IMG(src=plus_b64, id="plus", style={"height":"100%", "float":"right"})
+        increase = html.IMG(src=plus_b64, id="plus")
+        usestyle(increase, "spinplus")
         increase.bind("click", self.onincrease)
         self.currentvalue = initialvalue
         self.stepvalue = stepvalue
         self.minvalue = minvalue
         self.maxvalue = maxvalue
         widthems = max(len(str(minvalue)), len(str(maxvalue)))*0.6 + 3
-        self.valuespan = html.SPAN(str(self.currentvalue), style={"cursor":"default"})
-        styledict = {"border":"1px solid blue", "height":"1.1em", "width":f"{widthems}em", "text-align":"center"}
-        html.DIV.__init__(self,[decrease, self.valuespan, increase], Class="spincontrol", style=styledict)
+        self.valuespan = html.SPAN(str(self.currentvalue))
+        usestyle(self.valuespan, "spinvalue")
+        html.DIV.__init__(self,[decrease, self.valuespan, increase], Class="spincontrol")
+        usestyle(self, "spincontrol", {"width":f"{widthems}em"})
         self.action = action
         if className: self.classList.add(className)
         if id: self.id = id
@@ -262,6 +862,143 @@ class GridPanel(html.DIV):
         if className: self.classList.add(className)
         if id: self.id = id
 
+class VirtualGridPanel(html.DIV):
+    '''Grid for very large numbers of cells (eg thumbnails).  Only the cells which are visible (plus a margin of
+    overscan rows and columns) are in the document; the cell elements are reused as the grid is scrolled.
+    Required parameters:
+    cellcount: total number of cells
+    cellfactory: function which fills a cell.  Takes two arguments: the index of the cell (counting from 0),
+                 and the cell element (a DIV, which may previously have held another cell, so its content should be replaced).
+    columns: number of columns in the grid
+    Optional parameters:
+    cellwidth, cellheight: size of each cell in pixels
+    visiblecolumns, visiblerows: size of the panel, in cells (by default all the columns are visible)
+    overscan: number of extra rows and columns rendered on each side of the visible ones.
+    Available methods: render, refresh, scrolltocell'''
+    def __init__(self, cellcount, cellfactory, columns, cellwidth=100, cellheight=100, visiblecolumns=None, visiblerows=4, overscan=1, className=None, id=None):
+        html.DIV.__init__(self, "", Class="virtualgridpanel", style={"position":"relative", "overflow":"auto"})
+        self.cellfactory = cellfactory
+        self.columns = columns
+        self.cellwidth = cellwidth
+        self.cellheight = cellheight
+        self.visiblecolumns = visiblecolumns if visiblecolumns else columns
+        self.visiblerows = visiblerows
+        self.overscan = overscan
+        self.style.width = f"{self.visiblecolumns*cellwidth}px"
+        self.style.height = f"{visiblerows*cellheight}px"
+        self.shown = {}
+        self.pool = []
+        self.spacer = html.DIV("", style={"position":"relative", "width":f"{columns*cellwidth}px"})
+        self <= self.spacer
+        self.bind("scroll", self.render)
+        self.setcellcount(cellcount)
+        self.render()
+        if className: self.classList.add(className)
+        if id: self.id = id
+
+    @property
+    def topindex(self):
+        '''Index of the first cell in the top visible row.'''
+        return (int(self.scrollTop)//self.cellheight)*self.columns
+
+    def setcellcount(self, cellcount):
+        self.cellcount = cellcount
+        self.spacer.style.height = f"{-(-cellcount//self.columns)*self.cellheight}px"
+
+    def render(self, event=None):
+        '''Show the cells currently in view, reusing cells which have gone out of view.'''
+        rows = -(-self.cellcount//self.columns)
+        toprow = int(self.scrollTop)//self.cellheight
+        leftcolumn = int(self.scrollLeft)//self.cellwidth
+        rowrange = range(max(0, toprow-self.overscan), min(rows, toprow+self.visiblerows+1+self.overscan))
+        columnrange = range(max(0, leftcolumn-self.overscan), min(self.columns, leftcolumn+self.visiblecolumns+1+self.overscan))
+        wanted = [index for index in (row*self.columns+column for row in rowrange for column in columnrange) if index < self.cellcount]
+        wantedset = set(wanted)
+        for index in [index for index in self.shown if index not in wantedset]: self.pool.append(self.shown.pop(index))
+        for index in wanted:
+            if index in self.shown: continue
+            if self.pool:
+                cell = self.pool.pop()
+            else:
+                cell = html.DIV("", Class="virtualgridcell", style={"position":"absolute", "width":f"{self.cellwidth}px",
+                            "height":f"{self.cellheight}px", "overflow":"hidden", "box-sizing":"border-box"})
+                self.spacer <= cell
+            (row, column) = divmod(index, self.columns)
+            cell.style.left = f"{column*self.cellwidth}px"
+            cell.style.top = f"{row*self.cellheight}px"
+            cell.style.display = "block"
+            self.cellfactory(index, cell)
+            self.shown[index] = cell
+        for cell in self.pool: cell.style.display = "none"
+
+    def refresh(self, cellcount=None, topindex=None):
+        '''Redraw all the visible cells, eg after the data has changed.  The scroll position is kept, or if topindex is
+        given, the grid is scrolled so that the row containing that cell is where the top row was
+        (eg after inserting n cells before the visible ones, use refresh(cellcount, grid.topindex+n)).'''
+        offset = int(self.scrollTop) % self.cellheight
+        if cellcount is not None: self.setcellcount(cellcount)
+        self.pool += self.shown.values()
+        self.shown = {}
+        if topindex is not None: self.scrollTop = (topindex//self.columns)*self.cellheight + offset
+        self.render()
+
+    def scrolltocell(self, index):
+        '''Scroll so that cell number index is visible.'''
+        (row, column) = divmod(index, self.columns)
+        top, left = row*self.cellheight, column*self.cellwidth
+        if top < self.scrollTop: self.scrollTop = top
+        elif top+self.cellheight > self.scrollTop+self.clientHeight: self.scrollTop = top+self.cellheight-self.clientHeight
+        if left < self.scrollLeft: self.scrollLeft = left
+        elif left+self.cellwidth > self.scrollLeft+self.clientWidth: self.scrollLeft = left+self.cellwidth-self.clientWidth
+        self.render()
+
+class BatchBuilder():
+    '''Collects content for a container which is already in the page, then adds it all with a single insertion,
+    so that the browser only has to recalculate the layout once.  Use in a with statement:
+        with BatchBuilder(page) as batch:
+            batch <= html.H1("Title")
+            batch <= RowPanel([panel1, panel2])
+    Required parameter:
+    container: the element to which the content is added.
+    Optional parameter:
+    before: an element in container; if given, the content is inserted before it instead of at the end.
+    Available methods: <= (add content), setstyle, attach (called automatically at the end of the with statement).'''
+    def __init__(self, container, before=None):
+        self.container = container
+        self.before = before
+        self.fragment = document.createDocumentFragment()
+        self.styles = []
+
+    def __le__(self, items):
+        self.fragment <= items
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        if exctype is None: self.attach()
+
+    def setstyle(self, element, style):
+        '''Record a dict of CSS styles for element; all recorded styles are applied together just before attaching.'''
+        self.styles.append((element, style))
+
+    def attach(self):
+        for (element, style) in self.styles: element.style = style
+        self.styles = []
+        if self.before:
+            self.container.insertBefore(self.fragment, self.before)
+        else:
+            self.container <= self.fragment
+
+def measurelayout(action):
+    '''Call action() (a function with no arguments), then force the browser to lay out the page.
+    Returns the time taken in ms, for comparing ways of building the page.'''
+    start = window.performance.now()
+    action()
+    document.body.offsetHeight
+    return window.performance.now() - start
+
 class Button(html.BUTTON):
     '''Button with text (or blank).
     Required parameters:
@@ -293,12 +1030,15 @@ class ImageButton(Button):
 
 class ToggleButton(Button):
     '''Button which remains depressed when clicked, until clicked again or raised by other means.
-    For parameters see Button.'''
+    For parameters see Button.
+    The state is shown by the border colours: set inline (as before), or if Global.useStylesheet is True, by the classes
+    bw-raised and bw-lowered from the widgets' stylesheet, so that changing the state only toggles one class.'''
     def __init__(self, text, handler, bgcolour=None, tooltip=None, className=None, id=None):
         Button.__init__(self, text, self.onClick, bgcolour, tooltip, className, id)
         self.classList.add("togglebutton")
-        #self._selected = None
-        self.selected = False
+        usestyle(self, "raised")
+        self._selected = False
+        self.group = None
         self.handler = handler
 
     @property
@@ -307,16 +1047,17 @@ class ToggleButton(Button):
 
     @selected.setter
     def selected(self, selected):
+        selected = bool(selected)
+        if selected != self._selected:
+            if Global.useStylesheet: self.classList.toggle("bw-lowered", selected)
+            else: usestyle(self, "lowered" if selected else "raised")
         self._selected = selected
-        if self.selected:
-            self.style.borderTopColor = self.style.borderLeftColor = "grey"
-            self.style.borderBottomColor = self.style.borderRightColor = "white"
-        else:
-           self.style.borderTopColor = self.style.borderLeftColor = "white"
-           self.style.borderBottomColor = self.style.borderRightColor = "grey"
 
     def onClick(self, event):
-        self.selected = False if self.selected else True
+        if self.group:
+            self.group.onbuttonclick(self)
+        else:
+            self.selected = False if self.selected else True
         self.handler(event)
 
 class ToggleImageButton(ToggleButton):
@@ -328,6 +1069,54 @@ class ToggleImageButton(ToggleButton):
         self <= html.IMG(src=icon)
         self.classList.add("toggleimagebutton")
 
+class ToggleGroup():
+    '''A set of ToggleButtons (or ToggleImageButtons) which work together.
+    Required parameter:
+    buttons: list of the buttons in the group
+    Optional parameters:
+    exclusive: if True, at most one button can be selected at a time (like radio buttons).
+    allownone: if True (and exclusive is True), clicking the selected button unselects it.
+    Each button's own handler is still called when it is clicked.
+    Available methods: add, setselected; property selected (list of the selected buttons).'''
+    def __init__(self, buttons=[], exclusive=True, allownone=False):
+        self.buttons = []
+        self.exclusive = exclusive
+        self.allownone = allownone
+        for button in buttons: self.add(button)
+
+    def add(self, button):
+        button.group = self
+        self.buttons.append(button)
+
+    @property
+    def selected(self):
+        return [button for button in self.buttons if button.selected]
+
+    def setselected(self, mapping):
+        '''Set the state of several buttons at once.  mapping is a dict whose keys are buttons (or their positions
+        in the group) and whose values are True (selected) or False.  In an exclusive group, selecting a button
+        unselects the others.  Only the buttons whose state changes are altered.'''
+        states = [button.selected for button in self.buttons]
+        chosen = []
+        for (key, selected) in mapping.items():
+            index = key if isinstance(key, int) else self.buttons.index(key)
+            states[index] = bool(selected)
+            if selected: chosen.append(index)
+        if self.exclusive and chosen:
+            if len(chosen) > 1: raise ValueError("Only one button in an exclusive ToggleGroup can be selected")
+            states = [i == chosen[0] for i in range(len(states))]
+        for (button, selected) in zip(self.buttons, states):
+            if button.selected != selected: button.selected = selected
+
+    def onbuttonclick(self, button):
+        index = self.buttons.index(button)
+        if not self.exclusive:
+            self.setselected({index:not button.selected})
+        elif not button.selected:
+            self.setselected({index:True})
+        elif self.allownone:
+            self.setselected({index:False})
+
 class RadioButton(html.SPAN):
     '''One of a group of buttons - selecting one unselects the others.
     Required parameters:
@@ -392,11 +1181,11 @@ class ColourPickerButton(html.BUTTON):
         self.returnaction = returnaction
 
     def onClick(self, event):
-        global colourpickerdialog
-        if not colourpickerdialog:
-            colourpickerdialog = ColourPickerDialog()
+        if not dialogs.existing("colourpicker"):
+            colourpickerdialog = dialogs.get("colourpicker")
             colourpickerdialog.recentcolours[0].style.backgroundColor = self.style.backgroundColor
             colourpickerdialog.recent[0] = rgbtotuple(self.style.backgroundColor)
+        colourpickerdialog = dialogs.get("colourpicker")
         colourpickerdialog.returnaction = self.onChange
         colourpickerdialog.setupfromtuple(rgbtotuple(self.style.backgroundColor))
         colourpickerdialog.show()
@@ -419,35 +1208,39 @@ class ColourPickerImageButton(html.BUTTON):
         if id: self.id = id
 
     def onClick(self, event):
-        global colourpickerdialog
-        if not colourpickerdialog: colourpickerdialog = ColourPickerDialog()
+        colourpickerdialog = dialogs.get("colourpicker")
         colourpickerdialog.returnaction = self.returnaction
         colourpickerdialog.show()
 
 class ImageFromSVGButton(html.BUTTON):
     '''Button which opens an OverlayPanel showing a png image created from an SVG image.
     Required parameter:
-    svgimage: the image to be converted to png.'''
-    def __init__(self, svgimage, preprocess=None, className=None, id=None):
+    svgimage: the image to be converted to png.
+    Optional parameters:
+    scale: size of the png image relative to the SVG (eg 300/96 for a 300 DPI image).
+    tilesize: if set, the image is drawn in square tiles of this many pixels, so that only one tile at a time is rendered from the SVG.
+    The finished image is still one canvas, so it must be within Global.maxCanvasSide and Global.maxCanvasArea.'''
+    def __init__(self, svgimage, preprocess=None, scale=1, tilesize=None, className=None, id=None):
         html.BUTTON.__init__(self, html.IMG(src=copy_b64), type="button", title="Copy or Save...", Class="imagebutton")
         self.bind("click", self.onClick)
         self.svgimage = svgimage
         self.preprocess = preprocess if preprocess else None
+        self.scale = scale
+        self.tilesize = tilesize
         if className: self.classList.add(className)
         if id: self.id = id
 
     def onClick(self, event):
-        global imagefromsvg
         if self.preprocess: self.preprocess()
-        if not imagefromsvg: imagefromsvg = ImageFromSVG()
+        imagefromsvg = dialogs.get("imagefromsvg")
         imagefromsvg.show()
-        imagefromsvg.SVGtoPNG(self.svgimage)
+        imagefromsvg.SVGtoPNG(self.svgimage, self.scale, self.tilesize)
 
 class Overlay(html.DIV):
     '''Not intended to be created by end user'''
     def __init__(self, contents):
-        styledict = {"position":"fixed", "top":"0px", "bottom":"0px", "left":"0px", "right":"0px", "visibility":"hidden", "background-color":"transparent", "display":"flex", "align-items":"center"}
-        html.DIV.__init__(self, contents, style=styledict, Class="overlay")
+        html.DIV.__init__(self, contents, Class="overlay")
+        usestyle(self, "overlay")
 
 class OverlayPanel(html.DIV):
     '''An overlay page which fills the browser window (unlike a dialog box).
@@ -457,75 +1250,419 @@ class OverlayPanel(html.DIV):
             If not set, styling can be done using an external CSS stylesheet for classes .overlaypanel and .titlebar
     Available methods: show, hide, close (the last two are identical unless amended in a subclass).'''
     def __init__(self, title, style=None, id=None):
-        overlaystyle = {"position":"absolute", "top":"0px", "left":"0px", "width":"100%", "height":"100%"}
-        titlebarstyle = {"position":"relative", "width":"100%", "height":"1.2em", "text-align":"center"}
-        if style:
-            if style == "standard":
-                style = {"background-color":"lightgrey", "text-align":"center", "padding-bottom":"0.5em"}
-                titlebarstyle.update({"background-color":"grey", "color":"white"})
-            overlaystyle.update(style)
-        html.DIV.__init__(self, "", style=overlaystyle, Class="overlaypanel")
+        html.DIV.__init__(self, "", Class="overlaypanel")
+        usestyle(self, "overlaypanel")
+        if style == "standard": usestyle(self, "standardpanel")
+        elif style: self.style = style
         if id: self.id=id
         self.overlay = Overlay(self)
-        closebuttonstyle = {"position":"absolute", "top":"0px", "right":"0px", "height":"100%"}
-        closebutton = html.IMG(src=closebutton_b64, style=closebuttonstyle, Class = "closebutton")
+        closebutton = html.IMG(src=closebutton_b64, Class = "closebutton")
+        usestyle(closebutton, "closebutton")
         closebutton.bind("click", self.close)
-        titlebar = html.DIV([title, closebutton], style=titlebarstyle, Class="titlebar")
+        titlebar = html.DIV([title, closebutton], Class="titlebar")
+        usestyle(titlebar, "paneltitlebar")
+        if style == "standard": usestyle(titlebar, "standardtitlebar")
         self <= titlebar
         document <= self.overlay
 
     def show(self):
         self.overlay.style.visibility = "visible"
+        dialogs.onshow(self)
 
     def hide(self):
         self.overlay.style.visibility = "hidden"
+        dialogs.onhide(self)
 
     def close(self, event):
         self.hide()
 
+def svgsize(SVG):
+    '''Return the (width, height) of an svg element in pixels, from its attributes if possible.'''
+    try:
+        return (int(float(SVG.attrs["width"].replace("px", ""))), int(float(SVG.attrs["height"].replace("px", ""))))
+    except (KeyError, ValueError):
+        rect = SVG.getBoundingClientRect()
+        return (int(rect.width), int(rect.height))
+
+def canvassizeerror(width, height):
+    '''Return a message explaining why an image of this size cannot be made, or None if it can.'''
+    if max(width, height) <= Global.maxCanvasSide and width*height <= Global.maxCanvasArea: return None
+    return (f"The image would be {width} x {height} pixels, which is larger than the browser can draw "
+            f"(at most {Global.maxCanvasSide} pixels on each side, and {Global.maxCanvasArea} pixels altogether). Use a smaller scale.")
+
+class SVGRasteriser():
+    '''Not intended to be created by end user.  Converts svg elements to image blobs, one at a time, reusing a single IMG.
+    The SVG is loaded through a Blob URL (rather than a data URL, which means encoding the whole string),
+    and if the browser supports OffscreenCanvas, the drawing and encoding are done in a web worker.
+    Large images can be drawn in tiles, so that only one tile at a time is rendered from the SVG; the tiles are drawn
+    onto one canvas of the full size, so images larger than Global.maxCanvasSide and Global.maxCanvasArea are refused.
+    Finished blobs are kept in exportcache (keyed by a hash of the SVG and the image size and type),
+    so exporting an unchanged SVG again is immediate.'''
+    workersource = """
+var canvases = {};
+onmessage = function(event) {
+    var data = event.data;
+    if (data.cancel) {
+        delete canvases[data.id];
+        return;
+    }
+    if (!canvases[data.id]) canvases[data.id] = new OffscreenCanvas(data.width, data.height);
+    canvases[data.id].getContext("2d").drawImage(data.bitmap, data.x, data.y);
+    data.bitmap.close();
+    if (data.type) {
+        var canvas = canvases[data.id];
+        delete canvases[data.id];
+        canvas.convertToBlob({type: data.type}).then(
+            function(blob) {postMessage({id: data.id, blob: blob});},
+            function() {postMessage({id: data.id, blob: null});});
+    }
+};
+"""
+    def __init__(self):
+        self.useworker = all(hasattr(window, name) for name in ("Worker", "OffscreenCanvas", "createImageBitmap"))
+        self.worker = None
+        self.image = None
+        self.canvas = None
+        self.queue = []
+        self.busy = False
+        self.callbacks = {}
+        self.nextid = 0
+
+    def rasterise(self, SVG, callback, imagetype="image/png", scale=1, tilesize=None):
+        '''Convert SVG to an image blob of type imagetype, then call callback(blob), or callback(None) if it fails.
+        scale: size of the image relative to the size of the SVG.
+        tilesize: if set, the image is drawn in square tiles of this many pixels which are then put together.
+        If the image would be larger than the canvas limits (see canvassizeerror), callback(None) is called.'''
+        self.queue.append((SVG, callback, imagetype, scale, tilesize))
+        if not self.busy: self.nextjob()
+
+    def nextjob(self):
+        if not self.queue:
+            self.busy = False
+            return
+        self.busy = True
+        self.job = self.queue.pop(0)
+        (SVG, self.callback, self.imagetype, self.scale, tilesize) = self.job
+        if not self.image:
+            self.image = html.IMG()
+            self.image.bind("load", self.onload)
+            self.image.bind("error", self.onerror)
+        if self.useworker and not self.worker:
+            self.workerurl = window.URL.createObjectURL(window.Blob.new([self.workersource], {"type":"text/javascript"}))
+            self.worker = window.Worker.new(self.workerurl)
+            self.worker.onmessage = self.onworkermessage
+            self.worker.onerror = self.onworkererror
+        (width, height) = svgsize(SVG)
+        copy = SVG.cloneNode(True)
+        copy.setAttribute("width", width)
+        copy.setAttribute("height", height)
+        self.svgstring = window.XMLSerializer.new().serializeToString(copy)
+        self.width = round(width*self.scale)
+        self.height = round(height*self.scale)
+        if self.width <= 0 or self.height <= 0 or canvassizeerror(self.width, self.height):
+            self.callback(None)
+            self.nextjob()
+            return
+        key = f"{textdigest(self.svgstring)} {self.width}x{self.height} {self.imagetype}"
+        cached = exportcache.get(key)
+        if cached:
+            self.callback(cached)
+            self.nextjob()
+            return
+        self.callback = self.cacheresult(key, self.callback)
+        if not tilesize: tilesize = max(self.width, self.height)
+        self.tiles = [(x, y, min(tilesize, self.width-x), min(tilesize, self.height-y))
+                        for y in range(0, self.height, tilesize) for x in range(0, self.width, tilesize)]
+        self.jobid = self.nextid
+        self.nextid += 1
+        if not self.useworker:
+            if not self.canvas: self.canvas = html.CANVAS()
+            self.canvas.attrs["width"] = self.width
+            self.canvas.attrs["height"] = self.height
+        self.nexttile()
+
+    def cancel(self, callbacks):
+        '''Remove the jobs with any of these callbacks from the queue (the job being drawn, if any, is finished).'''
+        self.queue = [job for job in self.queue if job[1] not in callbacks]
+
+    def cacheresult(self, key, callback):
+        '''Return a callback which stores the finished blob in exportcache before passing it on.'''
+        def oncomplete(blob):
+            if blob: exportcache.put(key, blob)
+            callback(blob)
+        return oncomplete
+
+    def nexttile(self):
+        '''Load the next tile into the IMG, by wrapping the SVG in an outer svg whose viewBox is the area of the tile.'''
+        (x, y, width, height) = self.tiles[0]
+        scale = self.scale
+        header = f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="{x/scale} {y/scale} {width/scale} {height/scale}">'
+        self.url = window.URL.createObjectURL(window.Blob.new([header, self.svgstring, "</svg>"], {"type":"image/svg+xml;charset=utf-8"}))
+        self.image.attrs["src"] = self.url
+
+    def onload(self, event):
+        window.URL.revokeObjectURL(self.url)
+        if self.useworker:
+            (x, y, width, height) = self.tiles[0]
+            options = {"resizeWidth":width, "resizeHeight":height}
+            window.createImageBitmap(self.image, options).then(self.sendtoworker, self.restartjob)
+        else:
+            self.drawtile()
+
+    def onerror(self, event):
+        window.URL.revokeObjectURL(self.url)
+        if self.useworker: self.worker.postMessage({"id":self.jobid, "cancel":True})
+        self.callback(None)
+        self.nextjob()
+
+    def restartjob(self, error=None):
+        '''If createImageBitmap fails, do this job (and all later ones) on the main thread instead.'''
+        if not self.useworker: return
+        self.worker.postMessage({"id":self.jobid, "cancel":True})
+        self.useworker = False
+        self.queue.insert(0, self.job)
+        self.nextjob()
+
+    def drawtile(self):
+        (x, y, width, height) = self.tiles.pop(0)
+        self.canvas.getContext("2d").drawImage(self.image, x, y, width, height)
+        if self.tiles:
+            self.nexttile()
+        else:
+            self.canvas.toBlob(self.callback, self.imagetype)
+            self.nextjob()
+
+    def sendtoworker(self, bitmap):
+        if not self.useworker:
+            #The worker failed while this bitmap was being made, and the job has been restarted on the main thread
+            bitmap.close()
+            return
+        (x, y, width, height) = self.tiles.pop(0)
+        message = {"id":self.jobid, "bitmap":bitmap, "x":x, "y":y, "width":self.width, "height":self.height}
+        if not self.tiles:
+            message["type"] = self.imagetype
+            self.callbacks[self.jobid] = (self.job, self.callback)
+        self.worker.postMessage(message, [bitmap])
+        if self.tiles:
+            self.nexttile()
+        else:
+            self.nextjob()
+
+    def onworkermessage(self, event):
+        if event.data.id not in self.callbacks: return
+        (job, callback) = self.callbacks.pop(event.data.id)
+        callback(event.data.blob)
+
+    def onworkererror(self, event):
+        '''If the worker fails, redo the jobs it had been given, and the current job, on the main thread (as restartjob does).'''
+        self.useworker = False
+        self.worker.terminate()
+        self.worker = None
+        window.URL.revokeObjectURL(self.workerurl)
+        jobs = [self.callbacks[jobid][0] for jobid in sorted(self.callbacks)]
+        self.callbacks = {}
+        if self.busy: jobs.append(self.job)
+        self.queue[0:0] = jobs
+        if jobs: self.nextjob()
+
 class ImageFromSVG(OverlayPanel):
     '''Not intended to be created by end user.  To use, include an ImageFromSVGButton in the page.'''
     def __init__(self):
         OverlayPanel.__init__(self, "Right click to copy or save image", style="standard")
-        self.canvas = html.CANVAS(id="canvascopy")
-        #self <= self.canvas
-        #self.pngimage = html.IMG(id="pngcopy")
-        #self <= self.pngimage
-
-    def drawimage(self, event):
-        ctx = self.canvas.getContext("2d")
-        ctx.drawImage(self.svgimage, 0, 0)
-        self.canvas.toBlob(self.copyimage)
+        self.pngimage = html.IMG(id="pngcopy")
+        self <= self.pngimage
+        self.blobURL = None
 
     def copyimage(self, blob):
-        #def copycompleted(value):  ***navigator.clipboard only available over https***
-        #    print(value)
-        #    alert("The tessellation should have been copied to the clipboard ready to paste into a document, email etc.\n\n"+
-        #        "Alternatively, right-click or long-press on this page to save it.")
-        blobURL = window.URL.createObjectURL(blob)
-        self.pngimage = html.IMG(src=blobURL, id="pngcopy")
-        self <= self.pngimage
-        #self.pngimage.attrs["src"] = blobURL
-        #try:
-        #    clip = window.ClipboardItem.new({'image/png': blob})
-        #except AttributeError:
-        #    return
-        #window.navigator.clipboard.write([clip]).then(copycompleted)
-        #window.URL.revokeObjectURL(blobURL)
-
-    def SVGtoPNG(self, SVG):
-        xmls = window.XMLSerializer.new()
-        svgString = xmls.serializeToString(SVG)
-        self.canvas.attrs["width"] = SVG.attrs["width"]
-        self.canvas.attrs["height"] = SVG.attrs["height"]
-        self.svgimage = html.IMG()
-        self.svgimage.bind("load", self.drawimage)
-        self.svgimage.attrs["src"] = 'data:image/svg+xml; charset=utf8, '+window.encodeURIComponent(svgString);
+        #navigator.clipboard.write (with a ClipboardItem) would copy the image directly, but is only available over https
+        self.releaseimage()
+        if not blob:
+            showalert("Unable to create the image.")
+            return
+        self.blobURL = window.URL.createObjectURL(blob)
+        self.pngimage.attrs["src"] = self.blobURL
+
+    def releaseimage(self):
+        if not self.blobURL: return
+        self.pngimage.removeAttribute("src")
+        window.URL.revokeObjectURL(self.blobURL)
+        self.blobURL = None
+
+    def SVGtoPNG(self, SVG, scale=1, tilesize=None):
+        (width, height) = svgsize(SVG)
+        message = canvassizeerror(round(width*scale), round(height*scale))
+        if message:
+            self.hide()
+            showalert(message)
+            return
+        svgrasteriser.rasterise(SVG, self.copyimage, scale=scale, tilesize=tilesize)
 
     def close(self, event):
-        delete(self.pngimage)
+        self.releaseimage()
         self.hide()
 
+zipworkersource = """
+var table = [];
+for (var n = 0; n < 256; n++) {
+    var c = n;
+    for (var k = 0; k < 8; k++) c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+    table.push(c >>> 0);
+}
+function crc32(bytes) {
+    var crc = 0xFFFFFFFF;
+    for (var i = 0; i < bytes.length; i++) crc = table[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+onmessage = async function(event) {
+    try {
+        postMessage(await makezip(event.data));
+    } catch (error) {
+        postMessage(null);
+    }
+};
+async function makezip(files) {
+    var parts = [], central = [], offset = 0, centralsize = 0;
+    var encoder = new TextEncoder();
+    for (var i = 0; i < files.length; i++) {
+        var name = encoder.encode(files[i].name);
+        var data = new Uint8Array(await files[i].blob.arrayBuffer());
+        var crc = crc32(data);
+        var local = new DataView(new ArrayBuffer(30));
+        local.setUint32(0, 0x04034b50, true);
+        local.setUint16(4, 20, true);
+        local.setUint16(6, 0x0800, true);
+        local.setUint16(12, 0x21, true);
+        local.setUint32(14, crc, true);
+        local.setUint32(18, data.length, true);
+        local.setUint32(22, data.length, true);
+        local.setUint16(26, name.length, true);
+        parts.push(local, name, data);
+        var entry = new DataView(new ArrayBuffer(46));
+        entry.setUint32(0, 0x02014b50, true);
+        entry.setUint16(4, 20, true);
+        entry.setUint16(6, 20, true);
+        entry.setUint16(8, 0x0800, true);
+        entry.setUint16(14, 0x21, true);
+        entry.setUint32(16, crc, true);
+        entry.setUint32(20, data.length, true);
+        entry.setUint32(24, data.length, true);
+        entry.setUint16(28, name.length, true);
+        entry.setUint32(42, offset, true);
+        central.push(entry, name);
+        offset += 30 + name.length + data.length;
+        centralsize += 46 + name.length;
+    }
+    var end = new DataView(new ArrayBuffer(22));
+    end.setUint32(0, 0x06054b50, true);
+    end.setUint16(8, files.length, true);
+    end.setUint16(10, files.length, true);
+    end.setUint32(12, centralsize, true);
+    end.setUint32(16, offset, true);
+    return new Blob(parts.concat(central, [end]), {type: "application/zip"});
+}
+"""
+
+def makezip(files, callback):
+    '''Combine files (a list of (filename, blob) pairs) into a zip file, then call callback(zipblob), or callback(None) if it fails.
+    The files are stored rather than compressed (images are already compressed), and the work is done in a web worker.'''
+    workerurl = window.URL.createObjectURL(window.Blob.new([zipworkersource], {"type":"text/javascript"}))
+    worker = window.Worker.new(workerurl)
+    def onmessage(event):
+        worker.terminate()
+        window.URL.revokeObjectURL(workerurl)
+        callback(event.data)
+    def onerror(event):
+        worker.terminate()
+        window.URL.revokeObjectURL(workerurl)
+        callback(None)
+    worker.onmessage = onmessage
+    worker.onerror = onerror
+    worker.postMessage([{"name":filename, "blob":blob} for (filename, blob) in files])
+
+class BatchExport():
+    '''Exports a list of SVG images in one or more formats.
+    Required parameters:
+    images: a list of svg elements, or of (name, svg element) pairs (the names are used for the filenames).
+    oncomplete: function to be called when all the exports are finished (or the export is cancelled). Takes one argument:
+                a list of (filename, blob) pairs (blob is None for any export which failed or was cancelled),
+                or if zip is True, a zip file blob containing them (None if the zip file could not be made).
+    Optional parameters:
+    formats: a list of any of "png", "jpeg", "webp" and "svg".
+    onprogress: function to be called after each export. Takes two arguments: the number finished and the total number.
+    scale, tilesize: as for ImageFromSVGButton.
+    zip: if True, the results are put in a zip file.
+    concurrency: the maximum number of images waiting in the rasteriser's queue at once (if not given, Global.exportConcurrency is used).
+                 The rasteriser draws one image at a time, so this does not make exports run in parallel;
+                 it limits how many SVGs are copied ahead of time.
+    Available methods: start, cancel'''
+    def __init__(self, images, oncomplete, formats=["png"], onprogress=None, scale=1, tilesize=None, zip=False, concurrency=None):
+        self.jobs = []
+        for (i, image) in enumerate(images):
+            (name, SVG) = image if isinstance(image, (tuple, list)) else (f"image{i+1}", image)
+            for imageformat in formats: self.jobs.append((name, SVG, imageformat))
+        self.oncomplete = oncomplete
+        self.onprogress = onprogress
+        self.scale = scale
+        self.tilesize = tilesize
+        self.zip = zip
+        self.concurrency = concurrency if concurrency else Global.exportConcurrency
+        self.results = [None]*len(self.jobs)
+        self.nextjob = 0
+        self.running = 0
+        self.done = 0
+        self.pending = {}
+        self.cancelled = False
+        self.finished = False
+
+    def start(self):
+        if not self.jobs: self.finish()
+        while self.running < self.concurrency and self.nextjob < len(self.jobs): self.sendjob()
+
+    def cancel(self):
+        '''Stop exporting: remove this export's images from the rasteriser's queue and call oncomplete with the exports finished so far.'''
+        if self.cancelled or self.finished: return
+        self.cancelled = True
+        svgrasteriser.cancel(list(self.pending.values()))
+        self.pending = {}
+        for (index, (name, SVG, imageformat)) in enumerate(self.jobs):
+            if not self.results[index]: self.results[index] = (f"{name}.{imageformat}", None)
+        self.finish()
+
+    def sendjob(self):
+        index = self.nextjob
+        self.nextjob += 1
+        self.running += 1
+        (name, SVG, imageformat) = self.jobs[index]
+        if imageformat == "svg":
+            svgstring = window.XMLSerializer.new().serializeToString(SVG)
+            blob = window.Blob.new([svgstring], {"type":"image/svg+xml"})
+            timer.set_timeout(lambda: self.onexported(index, blob), 0)
+        else:
+            self.pending[index] = lambda blob: self.onexported(index, blob)
+            svgrasteriser.rasterise(SVG, self.pending[index], "image/"+imageformat, self.scale, self.tilesize)
+
+    def onexported(self, index, blob):
+        if self.cancelled: return
+        self.pending.pop(index, None)
+        (name, SVG, imageformat) = self.jobs[index]
+        #Browsers which cannot encode a format give a png instead, so take the extension from the blob
+        if blob: imageformat = blob.type.split("/")[-1].split("+")[0]
+        self.results[index] = (f"{name}.{imageformat}", blob)
+        self.running -= 1
+        self.done += 1
+        if self.onprogress: self.onprogress(self.done, len(self.jobs))
+        if self.nextjob < len(self.jobs):
+            self.sendjob()
+        elif self.running == 0:
+            self.finish()
+
+    def finish(self):
+        self.finished = True
+        if self.zip:
+            makezip([(filename, blob) for (filename, blob) in self.results if blob], self.oncomplete)
+        else:
+            self.oncomplete(self.results)
+
 class DialogBox(html.DIV):
     '''An overlay in the middle of the browser window.
     Required parameter: title (text for the title bar).
@@ -537,23 +1674,20 @@ class DialogBox(html.DIV):
     size: a tuple (width, height) in CSS units.
     Available methods: show, hide, close (the last two are identical unless amended in a subclass).'''
     def __init__(self, title, returnaction=None, content=None, style=None, size=None, id=None):
-        dialogstyle = {"position":"relative", "z-index":"1", "margin":"auto"}
-        titlebarstyle = {"position":"relative", "width":"100%", "height":"1.3em", "text-align":"center"}
-        if style:
-            if style == "standard":
-                style = {"width":"33%", "background-color":"lightgrey", "border":"1px solid grey", "text-align":"center", "padding-bottom":"0.5em"}
-                titlebarstyle.update({"background-color":"grey", "color":"white"})
-            dialogstyle.update(style)
+        html.DIV.__init__(self, "", Class="dialogbox")
+        usestyle(self, "dialogbox")
+        if style == "standard": usestyle(self, "standarddialog")
+        elif style: self.style = style
         if size:
             (width, height) = size
-            dialogstyle["width"] = width
-            dialogstyle["height"] = height
-        html.DIV.__init__(self, "", style=dialogstyle, Class="dialogbox")
-        closebuttonstyle = {"position":"absolute", "top":"0px", "right":"0px", "height":"100%"}
-        self.closebutton = html.IMG(src=closebutton_b64, style=closebuttonstyle, Class = "closebutton", id="closebutton")
+            usestyle(self, "dialogsize", {"width":width, "height":height})
+        self.closebutton = html.IMG(src=closebutton_b64, Class = "closebutton", id="closebutton")
+        usestyle(self.closebutton, "closebutton")
         self.closebutton.bind("click", self.close)
         self.titletext = html.SPAN(title)
-        titlebar = html.DIV([self.titletext, self.closebutton], style=titlebarstyle, Class="titlebar")
+        titlebar = html.DIV([self.titletext, self.closebutton], Class="titlebar")
+        usestyle(titlebar, "dialogtitlebar")
+        if style == "standard": usestyle(titlebar, "standardtitlebar")
         self <= titlebar
         if content: self <= content
         self.returnaction = returnaction
@@ -563,9 +1697,11 @@ class DialogBox(html.DIV):
 
     def show(self, event=None):
         self.overlay.style.visibility = "visible"
+        dialogs.onshow(self)
 
     def hide(self, event=None):
         self.overlay.style.visibility = "hidden"
+        dialogs.onhide(self)
 
     def close(self, event=None):
         self.hide()
@@ -622,38 +1758,47 @@ class PromptDialog(DialogBox):
 class ColourPickerDialog(DialogBox):
     '''Not intended to be created by end user.  To use, include a ColourPicker(Image)Button in the page.'''
     def __init__(self, returnaction=None):
-        def position(left, top, width=None, height=None):
-            posdict = {"position":"absolute", "top":f"{top}px", "left":f"{left}px"}
-            if width: posdict["width"] = f"{width}px"
-            if height: posdict["height"] = f"{height}px"
-            return posdict
+        def place(element, left, top, width=None, height=None):
+            #All four values are always given, so that none are inherited from an enclosing placed element
+            usestyle(element, "placed", {"left":f"{left}px", "top":f"{top}px", "width":f"{width}px" if width else "auto", "height":f"{height}px" if height else "auto"})
+            return element
         DialogBox.__init__(self, "Colour Picker", returnaction, size = ("380px", "360px"), style="standard")
-        imgstyle = position(0, 0)
-        self.basecolourbox = html.DIV("", style=position(10, 30, 256, 256))
-        self.basecolourbox <= html.IMG(src=whitemask_b64, style=imgstyle)
-        self.basecolourbox <= html.IMG(src=blackmask_b64, style=imgstyle)
-        self.colourpointer = html.IMG(src=circle_b64, style=imgstyle)
+        self.basecolourbox = place(html.DIV(""), 10, 30, 256, 256)
+        self.basecolourbox <= place(html.IMG(src=whitemask_b64), 0, 0)
+        self.basecolourbox <= place(html.IMG(src=blackmask_b64), 0, 0)
+        self.colourpointer = place(html.IMG(src=circle_b64), 0, 0)
         self.basecolourbox <= self.colourpointer
-        self.basecolourbox.bind("click", self.selectcolour)
         self <= self.basecolourbox
 
-        hueswatch = html.DIV(html.IMG(src=hues_b64, style=imgstyle), style=position(10, 300, 256, 48))
-        self.huepointer = html.IMG(src=circle_b64, style=imgstyle)
-        hueswatch <= self.huepointer
-        hueswatch.bind("click", self.selecthue)
-        self <= hueswatch
+        self.hueswatch = place(html.DIV(place(html.IMG(src=hues_b64), 0, 0)), 10, 300, 256, 48)
+        self.huepointer = place(html.IMG(src=circle_b64), 0, 0)
+        self.hueswatch <= self.huepointer
+        self <= self.hueswatch
+
+        self.dragging = None
+        self.dragpoint = None
+        self.dragrect = None
+        self.framerequest = None
+        self.shown = {}
+        self.colourpointer.position = self.huepointer.position = None
+        for box in (self.basecolourbox, self.hueswatch):
+            box.style.touchAction = "none"
+            box.bind("pointerdown", self.onpointerdown)
+            box.bind("pointermove", self.onpointermove)
+            box.bind("pointerup", self.onpointerup)
+            box.bind("pointercancel", self.onpointerup)
 
         self.hexcolourbox = InputBox(self.onhexinput)
-        self.hexcolourbox.style = position(280, 30, 80)
+        place(self.hexcolourbox, 280, 30, 80)
         self <= self.hexcolourbox
-        self.colourdemo = html.DIV("", style=position(286, 70, 70, 30))
+        self.colourdemo = place(html.DIV(""), 286, 70, 70, 30)
         self <= self.colourdemo
         self <= (selectbutton := Button("Select", self.onSelect))
-        selectbutton.style=position(286, 110, 70)
+        place(selectbutton, 286, 110, 70)
         selectbutton.style.margin = "0px"
-        self.recentcolours = [html.DIV("", id=f"recent{i}", style=position(280+30*(i%3), 150+30*(i//3), 25, 25)) for i in range(15)]
+        self.recentcolours = [place(html.DIV("", id=f"recent{i}"), 280+30*(i%3), 150+30*(i//3), 25, 25) for i in range(15)]
         for i in range(15):
-            self.recentcolours[i].style = {"border":"1px solid black", "background-color":"white"}
+            usestyle(self.recentcolours[i], "recentcolour")
             self.recentcolours[i].bind("click", self.onrecentchoice)
         self <= self.recentcolours
         self.recent = [(255, 255, 255)] * 15
@@ -667,38 +1812,70 @@ class ColourPickerDialog(DialogBox):
         self.setupfromtuple(self.recent[i])
 
 
-    def selecthue(self, event):
-        hueswatch = event.currentTarget.getBoundingClientRect()
-        x, y = int(event.clientX - hueswatch.left), int(event.clientY- hueswatch.top)
-        (self.huepointer.left, self.huepointer.top) = (x-5, y-5)
-        huenumber = x*6+y//8
+    def onpointerdown(self, event):
+        '''Start dragging on the hue swatch or the colour box.  The position of the box is only read once, at the start of the drag.'''
+        event.preventDefault()
+        self.dragging = event.currentTarget
+        self.dragrect = self.dragging.getBoundingClientRect()
+        self.dragging.setPointerCapture(event.pointerId)
+        self.dragpoint = (event.clientX, event.clientY)
+        self.applydrag()
+
+    def onpointermove(self, event):
+        '''Record the pointer position; the colour is updated at most once per animation frame.'''
+        if self.dragging is None: return
+        self.dragpoint = (event.clientX, event.clientY)
+        if self.framerequest is None: self.framerequest = window.requestAnimationFrame(self.applydrag)
+
+    def onpointerup(self, event):
+        if self.dragging is None: return
+        self.dragpoint = (event.clientX, event.clientY)
+        self.applydrag()
+        if self.dragging.hasPointerCapture(event.pointerId): self.dragging.releasePointerCapture(event.pointerId)
+        self.dragging = None
+
+    def applydrag(self, timestamp=None):
+        if self.framerequest is not None:
+            window.cancelAnimationFrame(self.framerequest)
+            self.framerequest = None
+        x, y = self.dragpoint[0] - self.dragrect.left, self.dragpoint[1] - self.dragrect.top
+        if self.dragging == self.hueswatch:
+            self.pickhue(min(max(int(x), 0), 255), min(max(int(y), 0), 47))
+        else:
+            self.pickcolour(min(max(x, 0), 255), min(max(y, 0), 255))
 
-        self.hue, self.colour = hwbtorgb(huenumber, self.whitealpha, self.blackalpha)
-        self.basecolourbox.style.backgroundColor = "rgb({},{},{})".format(*self.hue)
-        self.colourdemo.style.backgroundColor = "rgb({},{},{})".format(*self.colour)
-        self.hexcolourbox.value = tupletohex(self.colour)
+    def pickhue(self, x, y):
+        self.movepointer(self.huepointer, x, y)
+        self.hue, self.colour = hwbtorgb(x*6+y//8, self.whitealpha, self.blackalpha)
+        self.showcolours()
 
-    def selectcolour(self, event):
-        x, y = event.clientX - event.currentTarget.getBoundingClientRect().left, event.clientY- event.currentTarget.getBoundingClientRect().top
-        (self.colourpointer.left, self.colourpointer.top) = (int(x)-5, int(y)-5)
+    def pickcolour(self, x, y):
+        self.movepointer(self.colourpointer, int(x), int(y))
         (self.whitealpha, self.blackalpha) = (x/255, y/255)
         hue, self.colour = hwbtorgb(self.hue, self.whitealpha, self.blackalpha)
-        self.colourdemo.style.backgroundColor = "rgb({},{},{})".format(*self.colour)
-        self.hexcolourbox.value = tupletohex(self.colour)
+        self.showcolours()
+
+    def movepointer(self, pointer, x, y):
+        if pointer.position == (x, y): return
+        (pointer.left, pointer.top) = (x-5, y-5)
+        pointer.position = (x, y)
+
+    def showcolours(self):
+        '''Show the current hue and colour, changing only what has changed since they were last shown.'''
+        if self.shown.get("hue") != self.hue:
+            self.basecolourbox.style.backgroundColor = "rgb({},{},{})".format(*self.hue)
+            self.shown["hue"] = self.hue
+        if self.shown.get("colour") != self.colour:
+            self.colourdemo.style.backgroundColor = "rgb({},{},{})".format(*self.colour)
+            self.hexcolourbox.value = tupletohex(self.colour)
+            self.shown["colour"] = self.colour
 
     def setupfromtuple(self, colour):
-        self.colour = colour
-        self.colourdemo.style.backgroundColor = "rgb({},{},{})".format(*colour)
-        self.hexcolourbox.value = tupletohex(self.colour)
-
+        self.colour = tuple(colour)
         self.hue, huenumber, self.whitealpha, self.blackalpha = rgbtohwb(colour)
-
-        self.basecolourbox.style.backgroundColor = "rgb({},{},{})".format(*self.hue)
-        (x, y) = (int(self.whitealpha*255), int(self.blackalpha*255))
-        (self.colourpointer.left, self.colourpointer.top) = (x-5, y-5)
-
-        (x, y) = (huenumber//6, (huenumber%6)*8)
-        (self.huepointer.left, self.huepointer.top) = (x-5, y-5)
+        self.showcolours()
+        self.movepointer(self.colourpointer, int(self.whitealpha*255), int(self.blackalpha*255))
+        self.movepointer(self.huepointer, huenumber//6, (huenumber%6)*8)
 
     def onSelect(self, event):
         if self.colour not in self.recent: self.recent = [self.colour]+self.recent[:-1]
@@ -716,16 +1893,23 @@ class FileOpenButton(html.BUTTON):
     extlist: a list of file extensions which should be displayed in the dialog.  If omitted, all files will be displayed.
     initialfolder: the path to the folder initially displayed in the dialog.'''
     def __init__(self, returnaction, extlist=[], initialfolder=".", id=None):
-        global fileopendialog
         html.BUTTON.__init__(self, html.IMG(src=open_b64), type="button", title="Open File...", id=id, Class="imagebutton")
         self.classList.add("fileopenbutton")
         self.bind("click", self.onClick)
-        if not fileopendialog: fileopendialog = FileOpenDialog(returnaction, extlist)
+        self.returnaction = returnaction
+        self.extlist = extlist
         self.initialfolder = initialfolder
         if id: self.id = id
 
+    def getdialog(self):
+        '''Return the (shared) file open dialog, set up for this button.'''
+        dialog = dialogs.get("fileopen")
+        dialog.returnaction = self.returnaction
+        dialog.extlist = self.extlist
+        return dialog
+
     def onClick(self, event):
-        fileopendialog.open(self.initialfolder)
+        self.getdialog().open(self.initialfolder)
 
 class FileSaveAsButton(html.BUTTON):
     '''Button which opens a dialog for saving a file.
@@ -738,16 +1922,26 @@ class FileSaveAsButton(html.BUTTON):
     defaultextension: extension which will be appended to the filename given if not already present.
     initialfolder: the path to the folder initially displayed in the dialog.'''
     def __init__(self, preparefile, returnaction=None, extlist=[], defaultextension=None, initialfolder=".", id=None):
-        global filesavedialog
         html.BUTTON.__init__(self, html.IMG(src=saveas_b64), type="button", title="Save File As...", id=id, Class="imagebutton")
         self.classList.add("filesaveasbutton")
         self.bind("click", self.onClick)
-        if not filesavedialog: filesavedialog = FileSaveDialog(returnaction, extlist, defaultextension)
+        self.returnaction = returnaction
+        self.extlist = extlist
+        self.defaultextension = defaultextension
         self.initialfolder = initialfolder
         self.preparefile = preparefile
         if id: self.id = id
 
+    def getdialog(self):
+        '''Return the (shared) file save dialog, set up for this button.'''
+        dialog = dialogs.get("filesave")
+        dialog.returnaction = self.returnaction
+        dialog.extlist = self.extlist
+        dialog.defaultextension = self.defaultextension
+        return dialog
+
     def onClick(self, event):
+        filesavedialog = self.getdialog()
         filesavedialog.filetosave = self.preparefile()
         filesavedialog.open(self.initialfolder)
 
@@ -756,18 +1950,28 @@ class FileSaveButton(html.BUTTON):
     Otherwise it opens a dialog for saving a file.
     For parameters see FileSaveAsButton.'''
     def __init__(self, preparefile, returnaction=None, extlist=[], defaultextension=None, initialfolder=".", id=None):
-        global filesavedialog
         html.BUTTON.__init__(self, html.IMG(src=save_b64), type="button", title="Save File", id=id, Class="imagebutton")
         self.classList.add("filesavebutton")
         self.bind("click", self.onClick)
-        if not filesavedialog: filesavedialog = FileSaveDialog(returnaction, extlist, defaultextension)
+        self.returnaction = returnaction
+        self.extlist = extlist
+        self.defaultextension = defaultextension
         self.initialfolder = initialfolder
         self.preparefile = preparefile
         if id: self.id = id
 
+    def getdialog(self):
+        '''Return the (shared) file save dialog, set up for this button.'''
+        dialog = dialogs.get("filesave")
+        dialog.returnaction = self.returnaction
+        dialog.extlist = self.extlist
+        dialog.defaultextension = self.defaultextension
+        return dialog
+
     def onClick(self, event):
+        filesavedialog = self.getdialog()
         filesavedialog.filetosave = self.preparefile()
-        if filesavedialog.filename:
+        if filesavedialog.filepath:
             filesavedialog.autosave()
         else:
             filesavedialog.open(self.initialfolder)
@@ -783,7 +1987,7 @@ class UserFileOpenButton(FileOpenButton):
         if currentuser is None:
             showalert("In order to save or open files, you need to log in.\nPlease click the login button.")
         else:
-            fileopendialog.open("./users/"+currentuser)
+            self.getdialog().open("./users/"+currentuser)
 
 class UserFileSaveAsButton(FileSaveAsButton):
     '''Same as FilesaveAsButton, but requires a user to have their own folder to save files in - ie to be logged in.
@@ -796,6 +2000,7 @@ class UserFileSaveAsButton(FileSaveAsButton):
         if currentuser is None:
             showalert("In order to save or open files, you need to log in.\nPlease click the login button.")
         else:
+            filesavedialog = self.getdialog()
             filesavedialog.filetosave = self.preparefile()
             filesavedialog.open("./users/"+currentuser)
 
@@ -810,8 +2015,9 @@ class UserFileSaveButton(FileSaveButton):
         if currentuser is None:
             showalert("In order to save or open files, you need to log in.\nPlease click the login button.")
         else:
+            filesavedialog = self.getdialog()
             filesavedialog.filetosave = self.preparefile()
-            if filesavedialog.filename:
+            if filesavedialog.filepath:
                 filesavedialog.autosave()
             else:
                 filesavedialog.open("./users/"+currentuser)
@@ -822,14 +2028,15 @@ class LoginButton(html.BUTTON):
     returnaction: function to be called on returning from the dialog after a successful login.
     This function takes one argument - the username.'''
     def __init__(self, returnaction=None, id=None):
-        global logindialog
         html.BUTTON.__init__(self, html.IMG(src=login_b64), type="button", title="Log In...", Class="imagebutton")
         self.classList.add("loginbutton")
         self.bind("click", self.onClick)
-        if not logindialog: logindialog = LoginDialog("Please type your username below:", returnaction)
+        self.returnaction = returnaction
         if id: self.id = id
 
     def onClick(self, event):
+        logindialog = dialogs.get("login")
+        logindialog.returnaction = self.returnaction
         logindialog.open()
 
 class LoginDialog(DialogBox):
@@ -867,10 +2074,8 @@ class LoginDialog(DialogBox):
         request.send({"username":username})
 
     def openusernamedialog(self, event):
-        global usernamedialog
-        message = """Your username should consist of letters and numbers only.<br />
-        Choose something which you will remember but other people will not guess"""
-        if not usernamedialog: usernamedialog = UsernameDialog(message, self.returnaction)
+        usernamedialog = dialogs.get("username")
+        usernamedialog.returnaction = self.returnaction
         self.hide()
         usernamedialog.open()
 
@@ -908,6 +2113,7 @@ class UsernameDialog(DialogBox):
             global currentuser
             response = request.text.strip()
             if response == "OK":
+                invalidatelisting("users")
                 currentuser = username
                 if self.returnaction: self.returnaction(username)
                 showalert("Username created.  You are now logged in.")
@@ -923,11 +2129,29 @@ class FileDialog(DialogBox):
         DialogBox.__init__(self, title, returnaction, style="standard", id=id)
         self.path = None
         self.extlist = extlist
-        basestyle = {"display":"block", "width":"90%", "padding":"0.1em", "margin":"0.1em auto"}
-        self.fileinput = html.INPUT(style=basestyle)
-        liststyle = {**basestyle, "background-color":"white", "border":"1px solid black", "height":"70vh", "overflow":"auto", "white-space":"nowrap"}
-        self.filelistbox = html.UL(style=liststyle)
-        self.buttonarea = html.DIV(style={**basestyle, "text-align":"right"})
+        self.fileinput = html.INPUT()
+        usestyle(self.fileinput, "filedialogpart")
+        self.fileinput.bind("input", self.onfilterinput)
+        self.fileinput.bind("keydown", self.onfilterkeydown)
+        self.filelistbox = html.UL()
+        usestyle(self.filelistbox, "filedialogpart")
+        usestyle(self.filelistbox, "filelist")
+        self.filelistbox.bind("scroll", self.onlistscroll)
+        self.filelistbox.bind("click", self.onitemclick)
+        self.filelistbox.bind("dblclick", self.onitemdoubleclick)
+        self.selecteditem = None
+        self.listitems = []
+        self.nameindex = None
+        self.shownrows = self.shownorder = None
+        self.filtertext = ""
+        #With the stylesheet, the list items are styled by the rules for ".bw-filelist li"
+        self.listitemstyle = None if Global.useStylesheet else inlinestyles["filelist li"]
+        self.listinggeneration = 0
+        self.pagerequest = None
+        self.totalentries = None
+        self.buttonarea = html.DIV()
+        usestyle(self.buttonarea, "filedialogpart")
+        usestyle(self.buttonarea, "filebuttons")
         self <= (self.fileinput, self.filelistbox, self.buttonarea)
 
     def open(self, initialfolder="."):
@@ -936,86 +2160,304 @@ class FileDialog(DialogBox):
         self.show()
         self.fileinput.focus()
 
+    @property
+    def isopen(self):
+        return self.overlay.style.visibility == "visible"
+
+    def selectitem(self, item):
+        if self.selecteditem: self.selecteditem.style.backgroundColor = "white"
+        item.style.backgroundColor = "skyblue"
+        self.selecteditem = item
+        self.fileinput.value = item.text
+
     def onitemclick(self, event):
-        for item in self.filelistbox.select("li"): item.style.backgroundColor = "white"
-        event.target.style.backgroundColor = "skyblue"
-        if event.target.className != "parentfolder":
-            self.fileinput.value = event.target.text
+        if event.target.tagName != "LI" or event.target.className == "parentfolder": return
+        self.selectitem(event.target)
 
-    def onfolderdoubleclick(self, event):
-        self.path.append(event.target.text)
+    def onitemdoubleclick(self, event):
+        if event.target.tagName == "LI": self.openitem(event.target)
+
+    def openitem(self, item):
+        if item.className == "parentfolder": self.openparent()
+        elif item.className == "folder": self.openfolder(item.text)
+        else: self.openfile(item.text)
+
+    def openfolder(self, foldername):
+        self.path.append(foldername)
         self.getfilelist("/".join(self.path))
         self.fileinput.value = ""
 
-    def onfiledoubleclick(self, event):
+    def openfile(self, filename):
         pass
 
-    def onupdoubleclick(self, event):
+    def openparent(self):
         self.path.pop()
         self.getfilelist("/".join(self.path))
         self.fileinput.value = ""
 
+    def onfilterinput(self, event):
+        self.filterlist(self.fileinput.value)
+
+    def filterlist(self, text):
+        '''Show only the rows whose names match text (see NameIndex.match and Global.fileFilterMode).
+        Only rows whose visibility changes are touched.'''
+        self.filtertext = text
+        if self.nameindex is None: self.nameindex = NameIndex([item.text for item in self.listitems])
+        if text:
+            shown = self.nameindex.match(text, Global.fileFilterMode)
+        else:
+            shown = range(len(self.listitems))
+        shownset = set(shown)
+        previous = self.shownrows if self.shownrows is not None else set(range(len(self.listitems)))
+        for i in previous - shownset: self.listitems[i].style.display = "none"
+        for i in shownset - previous: self.listitems[i].style.display = "list-item"
+        self.shownrows = shownset
+        self.shownorder = list(shown)
+        if self.selecteditem and self.selecteditem.style.display == "none":
+            self.selecteditem.style.backgroundColor = "white"
+            self.selecteditem = None
+
+    def onfilterkeydown(self, event):
+        '''Up and down arrows move through the rows which are shown; Enter opens the selected row.'''
+        if event.key in ("ArrowDown", "ArrowUp"):
+            event.preventDefault()
+            if self.shownorder is None: self.shownorder = list(range(len(self.listitems)))
+            if not self.shownorder: return
+            if self.selecteditem:
+                position = bisect.bisect_left(self.shownorder, self.selecteditem.listposition)
+                position += 1 if event.key == "ArrowDown" else -1
+            else:
+                position = 0 if event.key == "ArrowDown" else len(self.shownorder)-1
+            item = self.listitems[self.shownorder[max(0, min(len(self.shownorder)-1, position))]]
+            self.selectitem(item)
+            item.scrollIntoView({"block":"nearest"})
+        elif event.key == "Enter" and self.selecteditem and self.selecteditem.text == self.fileinput.value:
+            event.preventDefault()
+            self.openitem(self.selecteditem)
+
     def getfilelist(self, folder):
+        self.listinggeneration += 1
+        self.pagerequest = None
+        if Global.fileListPageSize:
+            self.folderlist, self.filelist = [], []
+            self.totalentries = None
+            self.clearbox()
+            self.getfilepage(folder, 0)
+            return
+        self.totalentries = None
+        self.requestlisting("brywidgets/sendfilelist.cgi", {"folder":folder}, self.showlisting, self.updatelisting)
+
+    def requestlisting(self, url, data, onlisting, onchanged=None, onfailed=None):
+        '''Call onlisting with the text of the listing described by data.
+        A cached listing is used straight away if there is one; if it is more than Global.listingCacheFreshness ms old,
+        it is also fetched again in the background, and onchanged (if given) is called with the new text if it differs.
+        If the listing is not cached and the server does not send it, onfailed (if given) is called.'''
+        key = (normalisefolder(data["folder"]),) + tuple(f"{name}={data[name]}" for name in sorted(data) if name != "folder")
+        generation = self.listinggeneration
+        cached = listingcache.get(key)
+        if cached:
+            onlisting(cached[0])
+            if window.Date.now() - cached[1] < Global.listingCacheFreshness: return
+        def oncomplete(request):
+            if request.status != 200:
+                if onfailed and not cached and generation == self.listinggeneration: onfailed()
+                return
+            text = request.text
+            listingcache.put(key, (text, window.Date.now()))
+            if generation != self.listinggeneration: return
+            if not cached: onlisting(text)
+            elif text != cached[0] and onchanged: onchanged(text)
         request = ajax.ajax()
-        request.bind("complete", self.populatebox)
-        request.open("POST", "brywidgets/sendfilelist.cgi", True)
+        request.bind("complete", oncomplete)
+        request.open("POST", url, True)
         #request.set_header('content-type','application/x-www-form-urlencoded')
-        request.send({"folder":folder})
+        request.send(data)
+
+    def getfilepage(self, folder, offset):
+        '''Request the entries offset to offset+Global.fileListPageSize-1 of the listing of folder (folders before files).'''
+        def onpage(text):
+            self.pagerequest = None
+            self.populatepage(text)
+        def onchanged(text):
+            invalidatelisting(folder)
+            self.getfilelist(folder)
+        def onfailed():
+            #Allow the next scroll to ask for the page again
+            self.pagerequest = None
+            showalert("Sorry - unable to get the list of files from the server.")
+        self.pagerequest = True
+        data = {"folder":folder, "offset":offset, "limit":Global.fileListPageSize, "sort":Global.fileListSort, "extlist":",".join(self.extlist)}
+        self.requestlisting("brywidgets/sendfilepage.cgi", data, onpage, onchanged if offset == 0 else None, onfailed)
+
+    def populatepage(self, text):
+        counts, folderlist, filelist = text.strip().split(chr(30))
+        foldercount, filecount = counts.split(chr(31))
+        self.totalentries = int(foldercount) + int(filecount)
+        folderlist = [x for x in folderlist.split(chr(31)) if x]
+        filelist = [x for x in filelist.split(chr(31)) if x]
+        self.folderlist += folderlist
+        self.filelist += filelist
+        self.additems(folderlist, filelist)
+        self.onlistscroll()
+
+    def lookupname(self, filename, action):
+        '''Call action with "folder", "file" or None, according to what filename is in the current folder.
+        If the whole listing has arrived, it is used; otherwise (in paged mode) the server is asked.'''
+        loaded = len(self.folderlist) + len(self.filelist)
+        if not Global.fileListPageSize or (self.totalentries is not None and loaded >= self.totalentries):
+            action("folder" if filename in self.folderlist else "file" if filename in self.filelist else None)
+            return
+        def oncomplete(request):
+            response = request.text.strip() if request.status == 200 else ""
+            if response not in ("folder", "file", "none"):
+                showalert("Sorry - unable to check the name with the server.")
+                return
+            action(None if response == "none" else response)
+        request = ajax.ajax()
+        request.bind("complete", oncomplete)
+        request.open("POST", "brywidgets/checkpath.cgi", True)
+        request.send({"path":"/".join(self.path+[filename])})
+
+    def onlistscroll(self, event=None):
+        '''In paged mode, fetch the next page when the list is scrolled to within a screenful of its end.'''
+        if self.pagerequest or self.totalentries is None: return
+        loaded = len(self.folderlist) + len(self.filelist)
+        if loaded >= self.totalentries: return
+        box = self.filelistbox
+        if box.scrollTop + 2*box.clientHeight >= box.scrollHeight:
+            self.getfilepage("/".join(self.path), loaded)
 
     def populatebox(self, request):
-        folderlist, filelist = request.text.strip().split(chr(30))
+        self.showlisting(request.text)
+
+    def showlisting(self, text):
+        folderlist, filelist = text.strip().split(chr(30))
         self.folderlist = folderlist.split(chr(31))
         self.filelist = filelist.split(chr(31))
         if self.extlist: self.filelist = [filename for filename in self.filelist if filename.split(".")[-1] in self.extlist]
-
+        self.clearbox()
+        self.additems(self.folderlist, self.filelist)
+
+    def updatelisting(self, text):
+        '''Show a changed listing of the current folder, keeping the scroll position, the filter and the selected row.'''
+        scrolltop = self.filelistbox.scrollTop
+        selectedname = self.selecteditem.text if self.selecteditem else None
+        self.showlisting(text)
+        #Filter by the text in the box, which is what the user can see
+        if self.fileinput.value: self.filterlist(self.fileinput.value)
+        for item in self.listitems:
+            if item.text == selectedname and item.style.display != "none":
+                item.style.backgroundColor = "skyblue"
+                self.selecteditem = item
+                break
+        self.filelistbox.scrollTop = scrolltop
+
+    def clearbox(self):
         self.filelistbox.text = ""
-        listitemstyle = {"text-align":"left", "list-style":"none", "padding":"0px 0px 0px 20px", "margin":"0px", "cursor":"default"}
+        self.filelistbox.scrollTop = 0
+        self.selecteditem = None
+        self.listitems = []
+        self.nameindex = None
+        self.shownrows = self.shownorder = None
+        self.filtertext = ""
         if len(self.path) > 1:
-            listitemstyle["background"] = f"url({uparrow_b64}) no-repeat left top"
-            self.filelistbox <= (upalevel := html.LI("[Up a level]", Class="parentfolder", style=listitemstyle))
-            upalevel.bind("dblclick", self.onupdoubleclick)
-        listitemstyle["background"] = f"url({folder_b64}) no-repeat left top"
-        for x in self.folderlist:
-            self.filelistbox <= (item := html.LI(x, style=listitemstyle))
-            item.bind("click", self.onitemclick)
-            item.bind("dblclick", self.onfolderdoubleclick)
-        listitemstyle["background"] = f"url({file_b64}) no-repeat left top"
-        for x in self.filelist:
-            self.filelistbox <= (item := html.LI(x, style=listitemstyle))
-            item.bind("click", self.onitemclick)
-            item.bind("dblclick", self.onfiledoubleclick)
+            listitemstyle = {**self.listitemstyle, **inlinestyles["filelist li.parentfolder"]} if self.listitemstyle else {}
+            self.filelistbox <= html.LI("[Up a level]", Class="parentfolder", style=listitemstyle)
+
+    def additems(self, folderlist, filelist):
+        '''Append rows for the given folders and files to the list, in a single insertion.
+        The rows have no event handlers of their own: clicks are handled by the list (see onitemclick).'''
+        fragment = document.createDocumentFragment()
+        if self.listitemstyle:
+            listitemstyle = {**self.listitemstyle, **inlinestyles["filelist li.folder"]}
+            items = [html.LI(x, Class="folder", style=listitemstyle) for x in folderlist]
+            listitemstyle.update(inlinestyles["filelist li.file"])
+            items += [html.LI(x, Class="file", style=listitemstyle) for x in filelist]
+        else:
+            items = [html.LI(x, Class="folder") for x in folderlist] + [html.LI(x, Class="file") for x in filelist]
+        for i, item in enumerate(items, len(self.listitems)): item.listposition = i
+        fragment <= items
+        self.filelistbox <= fragment
+        self.listitems += items
+        self.nameindex = None
+        if self.shownrows is not None: self.filterlist(self.filtertext)
 
 class FileOpenDialog(FileDialog):
     '''Not intended to be created by end user.  To use, include a (User)FileOpenButton in the page.'''
     def __init__(self, returnaction=None, extlist=[]):
         FileDialog.__init__(self, "Open File", returnaction, extlist, id="fileopendialog")
-        self.buttonarea <= Button("Open", self.onopenbutton)
+        self.progresstext = html.SPAN("", style={"margin-right":"1em"})
+        self.cancelbutton = Button("Cancel", self.cancelload)
+        self.cancelbutton.style.display = "none"
+        self.buttonarea <= (self.progresstext, self.cancelbutton, Button("Open", self.onopenbutton))
+        self.loadrequest = None
 
-    def onfiledoubleclick(self, event):
-        filename = event.target.text
-        self.path.append(filename)
-        filepath = "/".join(self.path)
-        f = open(filepath).read()
-        self.path.pop()
-        filesavedialog.filename = filename
-        filesavedialog.path = self.path
-        self.hide()
-        self.returnaction(f, filename)
+    def openfile(self, filename):
+        folderpath = list(self.path)
+        self.loadfile("/".join(folderpath+[filename]), filename, folderpath)
 
     def onopenbutton(self, event):
         filename = self.fileinput.value
         if filename == "": return
-        self.path.append(filename)
-        filepath = "/".join(self.path)
-        if filename in self.folderlist:
-            self.getfilelist(filepath)
-        else:
-            f = open(filepath).read()
-            self.path.pop()
-            filesavedialog.filename = filename
-            filesavedialog.path = self.path
+        folderpath = list(self.path)
+        filepath = "/".join(folderpath+[filename])
+        def onlookup(kind):
+            if kind == "folder":
+                self.path = folderpath+[filename]
+                self.getfilelist(filepath)
+            else:
+                self.loadfile(filepath, filename, folderpath)
+        self.lookupname(filename, onlookup)
+
+    def loadfile(self, filepath, filename, folderpath):
+        '''Download the file in the background, showing progress in the dialog.
+        folderpath is the dialog's path (a list of folder names) to the folder containing the file.
+        When it has arrived, the dialog is closed and returnaction is called with the contents and name of the file.'''
+        def onprogress(event):
+            loaded = f"{event.loaded//1024} KB"
+            self.progresstext.text = f"Loading {filename}: " + (f"{loaded} of {event.total//1024} KB" if event.lengthComputable else loaded)
+        def onload(event):
+            if request is not self.loadrequest: return
+            self.endload()
+            if request.status != 200:
+                showalert(f"Sorry - {filename} could not be opened.")
+                return
+            #Save the file under the same name by default; if there is no save dialog yet, it picks this up when it is created
+            openedfile.clear()
+            openedfile.update(path=folderpath, filename=filename, filepath=filepath, text=request.responseText if Global.deltaSave else None)
+            filesavedialog = dialogs.existing("filesave")
+            if filesavedialog: filesavedialog.useopenedfile()
             self.hide()
-            self.returnaction(f, filename)
+            self.returnaction(request.responseText, filename)
+        def onerror(event):
+            if request is not self.loadrequest: return
+            self.endload()
+            showalert(f"Sorry - {filename} could not be opened.")
+        self.cancelload()
+        self.loadrequest = request = window.XMLHttpRequest.new()
+        request.addEventListener("progress", onprogress)
+        request.addEventListener("load", onload)
+        request.addEventListener("error", onerror)
+        request.open("GET", f"{filepath}?{int(window.Date.now())}", True)
+        request.overrideMimeType("text/plain; charset=utf-8")
+        request.send()
+        self.progresstext.text = f"Loading {filename}..."
+        self.cancelbutton.style.display = "inline-block"
+
+    def cancelload(self, event=None):
+        if self.loadrequest is None: return
+        request = self.loadrequest
+        self.endload()
+        request.abort()
+
+    def endload(self):
+        self.loadrequest = None
+        self.progresstext.text = ""
+        self.cancelbutton.style.display = "none"
+
+    def close(self, event=None):
+        self.cancelload()
+        self.hide()
 
 class FileSaveDialog(FileDialog):
     '''Not intended to be created by end user.  To use, include a (User)FileSave(As)Button in the page.'''
@@ -1023,8 +2465,21 @@ class FileSaveDialog(FileDialog):
         FileDialog.__init__(self, "Save File", returnaction, extlist, id="filesavedialog")
         self.buttonarea <= Button("Save", self.onsavebutton)
         self.filename = None
+        self.filepath = None
         self.filetosave = None
         self.defaultextension = defaultextension
+        self.lastsaved = LRUCache(20, 10000000)
+        self.saving = {}
+        self.useopenedfile()
+
+    def useopenedfile(self):
+        '''Take the name of the file last opened with the file open dialog (if any) as the name to save under.'''
+        if not openedfile: return
+        self.path = openedfile["path"]
+        self.filename = openedfile["filename"]
+        self.filepath = openedfile["filepath"]
+        if Global.deltaSave: self.lastsaved.put(self.filepath, openedfile["text"])
+        openedfile.clear()
 
     def onsavebutton(self, event):
         filename = self.fileinput.value
@@ -1034,33 +2489,86 @@ class FileSaveDialog(FileDialog):
         if self.defaultextension:
             ext = "."+self.defaultextension
             if filename[-4:] != ext: filename += ext
-        self.path.append(filename)
-        filepath = "/".join(self.path)
-        if filename in self.folderlist:
-            self.getfilelist(filepath)
-        else:
-            if filename in self.filelist:
+        folderpath = list(self.path)
+        filepath = "/".join(folderpath+[filename])
+        def onlookup(kind):
+            if kind == "folder":
+                self.path = folderpath+[filename]
+                self.getfilelist(filepath)
+                return
+            if kind == "file":
                 response = confirm("File exists. Overwrite?")
-                if response is False:
-                    self.path.pop()
-                    return
-            self.savefile(filepath, self.filetosave)
+                if response is False: return
             self.filename = filename
-            self.path.pop()
+            self.filepath = filepath
             self.hide()
-            self.returnaction(filename)
-
-    def autosave(self):
-        self.path.append(self.filename)
-        filepath = "/".join(self.path)
-        self.savefile(filepath, self.filetosave)
-        self.path.pop()
-        self.hide()
-        self.returnaction(self.filename)
+            self.savefile(filepath, self.filetosave, self.onsaved)
+        self.lookupname(filename, onlookup)
+
+    def autosave(self, oncomplete=None):
+        '''Save filetosave to the file it was last saved as or opened from (not wherever the dialog is showing now).
+        oncomplete (if given) is called with the file path and True or False for success.'''
+        def onsaved(filepath, success):
+            self.onsaved(filepath, success)
+            if oncomplete: oncomplete(filepath, success)
+        self.savefile(self.filepath, self.filetosave, onsaved)
+
+    def onsaved(self, filepath, success):
+        if not success:
+            showalert(f"Sorry - {filepath} could not be saved.")
+        elif self.returnaction:
+            self.returnaction(filepath.rpartition("/")[2])
+
+    def savefile(self, filepath, filetosave, oncomplete=None):
+        '''Send filetosave to the server.  If Global.deltaSave is set and the file has been saved or opened before,
+        only the changes since then are sent; otherwise the whole file is sent, in chunks if it is longer than Global.uploadChunkSize.
+        When the server has replied, oncomplete (if given) is called with filepath and True or False for success.
+        Only one save of a file is sent at a time: if the file is already being saved, this save waits until that one
+        has finished (replacing any other save of the file which is waiting).'''
+        if filepath in self.saving:
+            waiting = self.saving[filepath]
+            callbacks = waiting[1] if waiting else []
+            if oncomplete: callbacks.append(oncomplete)
+            self.saving[filepath] = (filetosave, callbacks)
+            return
+        self.saving[filepath] = None
+        folder = filepath.rpartition("/")[0]
+        invalidatelisting(folder)
+        def onsaved(success):
+            invalidatelisting(folder)
+            if success and Global.deltaSave: self.lastsaved.put(filepath, filetosave)
+            if oncomplete: oncomplete(filepath, success)
+            waiting = self.saving.pop(filepath)
+            if waiting:
+                (nextfile, callbacks) = waiting
+                def oncompleteall(filepath, success):
+                    for callback in callbacks: callback(filepath, success)
+                self.savefile(filepath, nextfile, oncompleteall)
+        base = self.lastsaved.get(filepath) if Global.deltaSave else None
+        if base is None: self.uploadfile(filepath, filetosave, onsaved)
+        else: self.sendpatch(filepath, base, filetosave, onsaved)
+
+    def sendpatch(self, filepath, base, filetosave, onsaved):
+        '''Send only the changes from base (the last version saved) to patchfile.cgi.
+        If the file on the server is no longer the same as base, the whole file is sent instead.'''
+        def oncomplete(request):
+            if request.status == 200 and request.text.strip() == "OK": onsaved(True)
+            else: self.uploadfile(filepath, filetosave, onsaved)
+        patch = json.dumps(linepatch(base, filetosave))
+        if len(patch) > len(filetosave)//2:
+            self.uploadfile(filepath, filetosave, onsaved)
+            return
+        request = ajax.ajax()
+        request.bind("complete", oncomplete)
+        request.open("POST", "brywidgets/patchfile.cgi", True)
+        request.send({"filepath":filepath, "basehash":textdigest(base), "newhash":textdigest(filetosave), "patch":patch})
 
-    def savefile(self, filepath, filetosave):
+    def uploadfile(self, filepath, filetosave, onsaved):
+        if Global.uploadChunkSize and len(filetosave) > Global.uploadChunkSize:
+            ChunkedUpload(filepath, filetosave, onsaved).start()
+            return
         request = ajax.ajax()
-        #request.bind("complete", self.closedialog)
+        request.bind("complete", lambda request: onsaved(request.status == 200 and request.text.strip() == "OK"))
         request.open("POST", "brywidgets/savefile.cgi", True)
         #request.set_header('content-type','application/x-www-form-urlencoded')
         request.send({"filepath":filepath, "filetosave":filetosave})
@@ -1068,17 +2576,147 @@ class FileSaveDialog(FileDialog):
     def closedialog(self, request):
         self.hide()
 
+class ChunkedUpload():
+    '''Not intended to be created by end user.  Used by FileSaveDialog.savefile for files longer than Global.uploadChunkSize.
+    Sends the file to savechunk.cgi in chunks, at most Global.uploadConcurrency at a time, retrying each chunk
+    up to Global.uploadRetries times, then asks the server to join the chunks together.
+    oncomplete is called with True or False once the server has confirmed (or failed) the reassembly.'''
+    def __init__(self, filepath, filetosave, oncomplete):
+        size = Global.uploadChunkSize
+        self.filepath = filepath
+        self.chunks = [filetosave[i:i+size] for i in range(0, len(filetosave), size)]
+        self.total = len(filetosave)
+        self.oncomplete = oncomplete
+        self.uploadid = f"{int(window.Date.now())}{random.randrange(10**9)}"
+        self.waiting = list(range(len(self.chunks)))
+        self.attempts = [0]*len(self.chunks)
+        self.inflight = 0
+        self.sent = 0
+        self.failed = False
+
+    def start(self):
+        self.progress()
+        self.sendmore()
+
+    def sendmore(self):
+        if self.failed: return
+        while self.waiting and self.inflight < Global.uploadConcurrency:
+            self.sendchunk(self.waiting.pop(0))
+
+    def sendchunk(self, index):
+        self.inflight += 1
+        request = ajax.ajax()
+        request.bind("complete", lambda request: self.onchunk(index, request))
+        request.open("POST", "brywidgets/savechunk.cgi", True)
+        request.send({"action":"chunk", "uploadid":self.uploadid, "index":index, "chunk":self.chunks[index]})
+
+    def onchunk(self, index, request):
+        self.inflight -= 1
+        if self.failed: return
+        if request.status == 200 and request.text.strip() == "OK":
+            self.sent += len(self.chunks[index])
+            self.progress()
+        elif self.attempts[index] < Global.uploadRetries:
+            self.attempts[index] += 1
+            self.inflight += 1
+            def retry():
+                self.inflight -= 1
+                if self.failed: return
+                self.waiting.append(index)
+                self.sendmore()
+            timer.set_timeout(retry, 500 * 2**self.attempts[index])
+            return
+        else:
+            self.failed = True
+            self.oncomplete(False)
+            return
+        if self.sent == self.total: self.assemble()
+        else: self.sendmore()
+
+    def assemble(self):
+        request = ajax.ajax()
+        request.bind("complete", lambda request: self.oncomplete(request.status == 200 and request.text.strip() == "OK"))
+        request.open("POST", "brywidgets/savechunk.cgi", True)
+        request.send({"action":"assemble", "uploadid":self.uploadid, "count":len(self.chunks), "filepath":self.filepath})
+
+    def progress(self):
+        if Global.uploadProgress: Global.uploadProgress(self.sent, self.total)
+
+class AutosaveScheduler():
+    '''Saves a file in the background after it has been changed, once a file name has been chosen (eg by the first click on the button).
+    Required parameter:
+    button: the FileSaveButton or UserFileSaveButton whose preparefile function supplies the contents of the file.
+    Optional parameters:
+    debounce: time in ms to wait after the latest change before saving.
+    maxwait: longest time in ms to wait after the first unsaved change, however often changes are made.
+    Call markdirty() whenever the file is changed.  Only one save of a file is in progress at a time; changes made
+    during a save are saved when it finishes.
+    Counters: savecount, failedsaves, queuedsaves (the number of times a save had to wait for the previous one),
+    lastlatency and averagelatency (time in ms from starting a save to the server confirming it).'''
+    def __init__(self, button, debounce=2000, maxwait=10000):
+        self.button = button
+        self.debounce = debounce
+        self.maxwait = maxwait
+        self.dirty = False
+        self.firstchange = None
+        self.timer = None
+        self.inflight = {}
+        self.waiting = set()
+        self.savecount = 0
+        self.failedsaves = 0
+        self.queuedsaves = 0
+        self.lastlatency = None
+        self.totallatency = 0
+
+    @property
+    def averagelatency(self):
+        return self.totallatency/self.savecount if self.savecount else None
+
+    def markdirty(self):
+        now = window.Date.now()
+        if not self.dirty: self.firstchange = now
+        self.dirty = True
+        if self.timer: timer.clear_timeout(self.timer)
+        self.timer = timer.set_timeout(self.save, min(self.debounce, max(0, self.firstchange + self.maxwait - now)))
+
+    def save(self):
+        self.timer = None
+        filesavedialog = dialogs.get("filesave") if openedfile else dialogs.existing("filesave")
+        if not self.dirty or not filesavedialog or not filesavedialog.filepath: return
+        #Wait while the user is choosing a file, which may change the name the file is saved under
+        fileopendialog = dialogs.existing("fileopen")
+        if filesavedialog.isopen or (fileopendialog and fileopendialog.isopen):
+            self.timer = timer.set_timeout(self.save, self.debounce)
+            return
+        filepath = filesavedialog.filepath
+        if filepath in self.inflight:
+            if filepath not in self.waiting: self.queuedsaves += 1
+            self.waiting.add(filepath)
+            return
+        self.dirty = False
+        self.inflight[filepath] = window.Date.now()
+        filesavedialog.filetosave = self.button.preparefile()
+        filesavedialog.autosave(self.onsaved)
+
+    def onsaved(self, filepath, success):
+        latency = window.Date.now() - self.inflight.pop(filepath)
+        if success:
+            self.savecount += 1
+            self.lastlatency = latency
+            self.totallatency += latency
+        else:
+            self.failedsaves += 1
+            self.dirty = True
+        if filepath in self.waiting:
+            self.waiting.discard(filepath)
+            self.save()
+
 def showalert(message, title=None):
     '''Similar to javascript alert function.
     By default, standard dialog box styling will be used.
     If the variable Global.alertStyle is set to None, the alert will be styled using CSS styling for the .dialogbox class.
     If desired, this can be overridden by setting up styling for the id #alertdialog.'''
-    global alertdialog
-    try:
-        alertdialog.showmessage(message, title)
-    except NameError:
-        alertdialog = AlertDialog()
-        alertdialog.showmessage(message, title)
+    dialogs.get("alert").showmessage(message, title)
 
 def showprompt(message, action=None, title=None, default=None):
     '''Similar to javascript prompt function.
@@ -1089,17 +2727,21 @@ def showprompt(message, action=None, title=None, default=None):
     By default, standard dialog box styling will be used.
     If the variable Global.promptStyle is set to None,  the prompt will be styled using CSS styling for the .dialogbox class.
     If desired, this can be overridden by setting up styling for the id #promptdialog.'''
-    global promptdialog
-    try:
-        promptdialog.showquery(message, action, title, default)
-    except NameError:
-        promptdialog = PromptDialog()
-        promptdialog.showquery(message, action, title, default)
-
-colourpickerdialog = None
-fileopendialog = None
-filesavedialog = None
-logindialog = None
-usernamedialog = None
+    dialogs.get("prompt").showquery(message, action, title, default)
+
+textmeasurer = TextMeasurer()
+dialogs = DialogRegistry()
+dialogs.register("colourpicker", ColourPickerDialog)
+dialogs.register("fileopen", FileOpenDialog)
+dialogs.register("filesave", FileSaveDialog)
+dialogs.register("login", lambda: LoginDialog("Please type your username below:"))
+dialogs.register("username", lambda: UsernameDialog("""Your username should consist of letters and numbers only.<br />
+        Choose something which you will remember but other people will not guess"""))
+dialogs.register("imagefromsvg", ImageFromSVG, releasable=True)
+dialogs.register("alert", AlertDialog, releasable=True)
+dialogs.register("prompt", PromptDialog, releasable=True)
 currentuser = None
-imagefromsvg = None
+openedfile = {}
+svgrasteriser = SVGRasteriser()
+listingcache = LRUCache(50, 2000000, lambda listing: len(listing[0]))
+exportcache = LRUCache(10, 50000000, lambda blob: blob.size)
@@ -40,7 +40,8 @@ page3 = ws.NotebookPage("CSS", "lightgreen", html.TEXTAREA(open("demo.css").read
 page4 = ws.NotebookPage("HTML", "lightpink", html.TEXTAREA(open("demo.html").read()), id="page4")
 document <= ws.Notebook([page1, page2, page3, page4])
 
-page1 <= (html.H1("Brywidgets Demo"),
+batch = ws.BatchBuilder(page1)
+batch <= (html.H1("Brywidgets Demo"),
             html.P("""This page is a demo of most of the widgets in the brywidgets module.
                 The whole page is a Notebook with 4 tabs - the other 3 tabs show the files which create this page.
                 This page contains a RowPanel with two Panels each containing a ColumnPanel.
@@ -70,4 +71,5 @@ panel2 <= ws.ColumnPanel([html.P("(This is a FileOpenButton, FileSaveButton and
                 ws.UserFileSaveButton(gettext, showfilename),
                 ws.UserFileSaveAsButton(gettext, showfilename)])])
 
-page1 <= ws.RowPanel([panel1, panel2])
+batch <= ws.RowPanel([panel1, panel2])
+batch.attach()